@@ -0,0 +1,197 @@
+"""
+Seeds a synthetic catalogue: users, songs with three charts each, favs
+skewed towards a few popular songs, and small but valid WAV, PNG and chart
+blobs on disk. The same seed always produces the same catalogue.
+
+Used by bench/suite.py, or on its own to fill a throwaway database:
+
+    python bench/catalogue.py --database-url sqlite:///bench.db --storage-dir bench-storage --songs 5000
+"""
+import argparse
+import gzip
+import hashlib
+import os
+import random
+import struct
+import sys
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import Session
+
+from db import crud, models
+
+SYLLABLES = "ka ri no mi sa to ne ra vel lo dri an ex um bra sol tin mar zo fen qui ash".split()
+# every two syllable word, so a search term matches a realistic share of titles
+WORDS = [first + second for first in SYLLABLES for second in SYLLABLES if first != second]
+LEVELS = (("easy", 1, 5), ("normal", 4, 9), ("hard", 8, 14))
+# a few distinct blobs of each kind are shared by many songs, like re-uploads
+BLOB_VARIANTS = 32
+
+
+def wav_bytes(rng: random.Random, kilobytes: int) -> bytes:
+    samples = bytes(rng.getrandbits(8) for _ in range(256)) * (kilobytes * 4)
+    header = b"RIFF" + struct.pack("<I", 36 + len(samples)) + b"WAVE"
+    fmt = b"fmt " + struct.pack("<IHHIIHH", 16, 1, 2, 44100, 44100 * 4, 4, 16)
+    return header + fmt + b"data" + struct.pack("<I", len(samples)) + samples
+
+
+def png_bytes(rng: random.Random, size: int) -> bytes:
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    color = bytes(rng.getrandbits(8) for _ in range(3))
+    rows = b"".join(b"\x00" + color * size for _ in range(size))
+    return (
+        b"\x89PNG\r\n\x1a\n"
+        + chunk(b"IHDR", struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0))
+        + chunk(b"IDAT", zlib.compress(rows))
+        + chunk(b"IEND", b"")
+    )
+
+
+def chart_bytes(rng: random.Random, notes: int) -> bytes:
+    lines = [f"{rng.randrange(0, 600000)},{rng.randrange(0, 4)},{rng.choice('tsh')}" for _ in range(notes)]
+    return ("\n".join(sorted(lines)) + "\n").encode()
+
+
+def song_info_xml(title: str, artist: str) -> bytes:
+    return (
+        f'<song><title>{title}</title><artist>{artist}</artist>'
+        '<easy difficulty="3" charter="bench"/><normal difficulty="6" charter="bench"/>'
+        '<hard difficulty="11" charter="bench"/><jacket artist="bench"/></song>'
+    ).encode()
+
+
+def title(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS).capitalize() for _ in range(rng.randint(1, 4)))
+
+
+def _store(storage_dir: str, kind: str, data: bytes, suffix: str, name: str = None) -> str:
+    name = name or f"{hashlib.sha256(data).hexdigest()}{suffix}"
+    path = os.path.join(storage_dir, kind, name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+    return name
+
+
+def make_blobs(rng: random.Random, storage_dir: str, audio_kb: int):
+    """
+    Writes BLOB_VARIANTS blobs of each kind and returns their names and sizes.
+    Charts are stored gzip compressed and named after their content, as
+    files.charts.save_chart does.
+    """
+    blobs = {"audio": [], "images": [], "charts": []}
+    for _ in range(BLOB_VARIANTS):
+        audio = wav_bytes(rng, audio_kb)
+        blobs["audio"].append((_store(storage_dir, "audio", audio, ".wav"), len(audio)))
+        image = png_bytes(rng, 512)
+        blobs["images"].append((_store(storage_dir, "images", image, ".png"), len(image)))
+        chart = chart_bytes(rng, rng.randint(200, 1500))
+        compressed = gzip.compress(chart, compresslevel=9, mtime=0)
+        name = _store(storage_dir, "charts", compressed, "", f"{hashlib.sha256(chart).hexdigest()}.chart")
+        blobs["charts"].append((name, len(compressed)))
+    return blobs
+
+
+def popularity_weights(songs: int, exponent: float):
+    """
+    Cumulative Zipf weights of song ids 1 to songs, for random.choices.
+    """
+    cumulative = []
+    total = 0.0
+    for rank in range(1, songs + 1):
+        total += 1 / rank ** exponent
+        cumulative.append(total)
+    return cumulative
+
+
+def seed(
+    db: Session,
+    storage_dir: str,
+    users: int = 200,
+    songs: int = 2000,
+    favs_per_user: float = 20,
+    popularity: float = 1.1,
+    audio_kb: int = 256,
+    password_hash: str = "x",
+    seed: int = 1,
+):
+    """
+    Fills an empty database. Song popularity follows a Zipf law with the
+    given exponent, so the first songs collect most favs, and each user
+    favs a geometrically distributed number of songs averaging favs_per_user.
+    """
+    rng = random.Random(seed)
+    blobs = make_blobs(rng, storage_dir, audio_kb)
+    refcounts = {}
+
+    db.execute(insert(models.User), [
+        {"id": i, "username": f"user{i}", "hashed_password": password_hash, "uploaded_count": 0, "faved_count": 0}
+        for i in range(1, users + 1)
+    ])
+    song_rows, chart_rows = [], []
+    for song_id in range(1, songs + 1):
+        music, _ = rng.choice(blobs["audio"])
+        jacket, _ = rng.choice(blobs["images"])
+        refcounts[music] = refcounts.get(music, 0) + 1
+        refcounts[jacket] = refcounts.get(jacket, 0) + 1
+        song_rows.append({
+            "id": song_id, "song_name": title(rng), "author": title(rng), "jacket": jacket,
+            "jacket_artist": title(rng), "music": music, "uploader": rng.randint(1, users), "audio_status": "ready",
+        })
+        for level, low, high in LEVELS:
+            chart, _ = rng.choice(blobs["charts"])
+            refcounts[chart] = refcounts.get(chart, 0) + 1
+            value = rng.randint(low, high)
+            chart_rows.append({
+                "song_id": song_id, "level": level, "difficulty": str(value), "difficulty_value": value,
+                "charter": title(rng), "blob": chart,
+            })
+    db.execute(insert(models.Song), song_rows)
+    db.execute(insert(models.Chart), chart_rows)
+    db.execute(insert(models.Blob), [
+        {"name": name, "kind": kind, "size": size, "refcount": refcounts.get(name, 0)}
+        for kind, entries in blobs.items() for name, size in entries
+    ])
+
+    cumulative = popularity_weights(songs, popularity)
+    song_ids = range(1, songs + 1)
+    fav_rows = []
+    for user_id in range(1, users + 1):
+        count = min(songs, int(rng.expovariate(1 / favs_per_user))) if favs_per_user > 0 else 0
+        faved = set(rng.choices(song_ids, cum_weights=cumulative, k=count))
+        fav_rows.extend({"user_id": user_id, "song_id": song_id} for song_id in faved)
+    if fav_rows:
+        db.execute(insert(models.association_table), fav_rows)
+    if db.get_bind().dialect.name == "postgresql":
+        # ids were given explicitly, later inserts must not reuse them
+        for table in ("users", "songs"):
+            db.execute(text(f"select setval(pg_get_serial_sequence('{table}', 'id'), (select max(id) from {table}))"))
+    db.commit()
+    crud.reconcile_stats(db)
+    return {"users": users, "songs": songs, "favs": len(fav_rows)}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--storage-dir", required=True)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--favs-per-user", type=float, default=20)
+    parser.add_argument("--audio-kb", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    engine = create_engine(args.database_url)
+    models.Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        print(seed(db, args.storage_dir, args.users, args.songs, args.favs_per_user, audio_kb=args.audio_kb, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+"""
+Measures /songs/ latency while a storm of logins hits /token.
+
+Run it against a live server, once on the old build and once on the new one:
+
+    python bench/login_storm.py --url http://localhost:8000 --username bench --password bench
+"""
+import argparse
+import statistics
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def login_loop(url, username, password, stop):
+    data = urllib.parse.urlencode({"username": username, "password": password}).encode()
+    while not stop.is_set():
+        try:
+            urllib.request.urlopen(f"{url}/token", data=data).read()
+        except Exception:
+            pass
+
+
+def measure_songs(url, requests):
+    latencies = []
+    for _ in range(requests):
+        started = time.perf_counter()
+        urllib.request.urlopen(f"{url}/songs/").read()
+        latencies.append((time.perf_counter() - started) * 1000)
+    return latencies
+
+
+def report(label, latencies):
+    print(
+        f"{label:>18}: p50={statistics.median(latencies):7.1f}ms "
+        f"p99={percentile(latencies, 99):7.1f}ms max={max(latencies):7.1f}ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--logins", type=int, default=16, help="concurrent login clients")
+    parser.add_argument("--requests", type=int, default=200, help="/songs/ requests per phase")
+    args = parser.parse_args()
+
+    report("idle", measure_songs(args.url, args.requests))
+
+    stop = threading.Event()
+    workers = [
+        threading.Thread(target=login_loop, args=(args.url, args.username, args.password, stop), daemon=True)
+        for _ in range(args.logins)
+    ]
+    for worker in workers:
+        worker.start()
+    try:
+        report(f"{args.logins} logins", measure_songs(args.url, args.requests))
+    finally:
+        stop.set()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Measures the cost of turning one page of /songs/ into response bytes, the
+old way (ORM rows validated through schemas.Song and jsonable_encoder) against
+the listing path (tuples mapped to dicts and encoded by response.fastjson).
+
+Runs on an in-memory SQLite catalogue, no server needed:
+
+    python bench/serialization.py --songs 2000 --page 100
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from db import crud, models, schemas
+from response import fastjson
+
+
+def seed(db, songs):
+    user = models.User(username="bench", hashed_password="x")
+    db.add(user)
+    db.flush()
+    for i in range(songs):
+        db.add(models.Song(
+            song_name=f"Song {i}", author=f"Artist {i % 97}", music=f"{i:064x}.wav",
+            jacket=f"{i:064x}.png", jacket_artist="Jacket artist", uploader=user.id,
+            charts=[
+                models.Chart(level=level, difficulty=str(n), difficulty_value=n, charter=f"Charter {i % 13}", blob=f"{i:062x}{n:02x}.chart")
+                for n, level in enumerate(("easy", "normal", "hard"), start=1)
+            ],
+        ))
+    db.commit()
+    return schemas.User.from_orm(user)
+
+
+def orm_page(db, user, page, after):
+    if user is None:
+        songs = [schemas.Song.from_orm(song) for song in db.query(models.Song).filter(models.Song.id > after).order_by(models.Song.id).limit(page)]
+    else:
+        rows = crud._query_songs_faved_by(db, user.id).filter(models.Song.id > after).order_by(models.Song.id).limit(page)
+        songs = [crud._song_with_fav(song, is_faved) for song, is_faved in rows]
+    # what FastAPI does with a List[schemas.Song] response_model
+    validated = [schemas.Song.parse_obj(jsonable_encoder(song)) for song in songs]
+    return JSONResponse(jsonable_encoder(validated)).body
+
+
+def listing_page(db, user, page, after):
+    return fastjson.FastJSONResponse(crud.get_songs(db, user, limit=page, after=after)).body
+
+
+def measure(label, render, session, user, songs, page, rounds):
+    timings = []
+    for round in range(rounds):
+        db = session()
+        after = (round * page) % max(songs - page, 1)
+        started = time.perf_counter()
+        render(db, user, page, after)
+        timings.append((time.perf_counter() - started) * 1000)
+        db.close()
+    print(f"{label:>30}: median={statistics.median(timings):7.2f}ms min={min(timings):7.2f}ms per {page} songs")
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=50)
+    args = parser.parse_args()
+
+    # one in-memory database shared by every session
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    session = sessionmaker(bind=engine)
+    models.Base.metadata.create_all(bind=engine)
+    with session() as db:
+        user = seed(db, args.songs)
+
+    print(f"orjson: {'yes' if fastjson.orjson is not None else 'no, stdlib json'}")
+    for label, user_arg in (("anonymous", None), ("authenticated", user)):
+        before = measure(f"orm + pydantic, {label}", orm_page, session, user_arg, args.songs, args.page, args.rounds)
+        after = measure(f"listing, {label}", listing_page, session, user_arg, args.songs, args.page, args.rounds)
+        print(f"{'':>30}  {before / after:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
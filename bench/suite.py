@@ -0,0 +1,291 @@
+"""
+Runs the app in-process against a synthetic catalogue and measures the main
+request paths. For every scenario it records requests per second, p50, p99
+and max latency, errors, SQL statements per request and the peak RSS of the
+process, and writes everything to a JSON file that can be compared against
+an earlier run:
+
+    python bench/suite.py --output before.json
+    git checkout my-branch
+    python bench/suite.py --output after.json --compare before.json
+
+By default the catalogue goes into a fresh SQLite file in a temporary
+directory. Pass --database-url to use a throwaway Postgres database
+instead, which must be empty, and --async to go through the async driver.
+The numbers exclude the network and the ASGI server, so they show what the
+application code itself costs. Needs `pip install httpx`.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+SCENARIOS = ["listing", "auth_listing", "search", "upload", "download"]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def configure(args, workdir):
+    """
+    Environment the app reads at import. Transcoding is off so uploads do not
+    start ffmpeg in the middle of a measurement.
+    """
+    os.environ["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ["DB_ASYNC"] = "true" if args.use_async else "false"
+    os.environ["STORAGE_DIR"] = os.path.join(workdir, "storage")
+    os.environ["TRANSCODE_FORMATS"] = ""
+    os.environ.setdefault("SECRET_KEY", "bench" * 8)
+    os.environ.setdefault("ALGORITHM", "HS256")
+    os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "60")
+    os.environ.setdefault("STORE_NAME", "Benchmark store")
+    os.environ.setdefault("STORE_DESCRIPTION", "Synthetic catalogue")
+
+
+def seed_catalogue(args):
+    from passlib.context import CryptContext
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    from bench import catalogue
+    from db import models
+
+    engine = create_engine(os.environ["DATABASE_URL"])
+    models.Base.metadata.create_all(engine)
+    with Session(engine) as db:
+        if db.query(models.Song.id).first() is not None:
+            sys.exit("the benchmark database must be empty")
+        started = time.perf_counter()
+        counts = catalogue.seed(
+            db, os.environ["STORAGE_DIR"], users=args.users, songs=args.songs, favs_per_user=args.favs_per_user,
+            popularity=args.popularity, audio_kb=args.audio_kb,
+            password_hash=CryptContext(schemes=["bcrypt"]).hash("bench"), seed=args.seed,
+        )
+    engine.dispose()
+    counts["seconds"] = round(time.perf_counter() - started, 2)
+    return counts
+
+
+class Scenarios:
+    """
+    One request of each scenario at a time, picked from rng so a run with
+    the same seed sends the same requests.
+    """
+
+    def __init__(self, main, catalogue, args, rng):
+        self.args = args
+        self.rng = rng
+        self.catalogue = catalogue
+        self.pagination = main.pagination
+        self.popular = catalogue.popularity_weights(args.songs, args.popularity)
+        self.song_ids = range(1, args.songs + 1)
+        self.tokens = [
+            main.create_access_token({"sub": f"user{user_id}", "uid": user_id}, timedelta(hours=1))
+            for user_id in range(1, min(args.users, 50) + 1)
+        ]
+
+    def popular_song(self):
+        return self.rng.choices(self.song_ids, cum_weights=self.popular)[0]
+
+    def page(self):
+        # a page somewhere in the catalogue, as reached by following X-Next-Cursor
+        return {"after": self.pagination.encode_cursor("songs", self.rng.randrange(0, self.args.songs)), "limit": 100}
+
+    def listing(self, client):
+        return client.get("/songs/", params=self.page())
+
+    def auth_listing(self, client):
+        headers = {"Authorization": f"Bearer {self.rng.choice(self.tokens)}"}
+        return client.get("/songs/", params=self.page(), headers=headers)
+
+    def search(self, client):
+        words = self.rng.sample(self.catalogue.WORDS, self.rng.randint(1, 2))
+        # the last word is often still being typed
+        words[-1] = words[-1][:self.rng.randint(3, len(words[-1]))]
+        return client.get("/songs/search", params={"q": " ".join(words)})
+
+    def upload(self, client):
+        rng = self.rng
+        files = {
+            "song_info": ("song.xml", self.catalogue.song_info_xml(self.catalogue.title(rng), self.catalogue.title(rng))),
+            "audio": ("song.wav", self.catalogue.wav_bytes(rng, self.args.upload_kb)),
+            "art": ("jacket.png", self.catalogue.png_bytes(rng, 256)),
+        }
+        for level, _, _ in self.catalogue.LEVELS:
+            files[level] = (f"{level}.chart", self.catalogue.chart_bytes(rng, 500))
+        headers = {"Authorization": f"Bearer {rng.choice(self.tokens)}"}
+        return client.post("/songs/", files=files, headers=headers)
+
+    def download(self, client):
+        song_id = self.popular_song()
+        if self.rng.random() < 0.5:
+            return client.get(f"/songs/{song_id}/audio")
+        level = self.rng.choice(self.catalogue.LEVELS)[0]
+        return client.get(f"/songs/{song_id}/{level}", headers={"Accept-Encoding": "gzip"})
+
+
+async def run_scenario(client, request, requests, concurrency):
+    from metrics.requests import db_queries
+
+    latencies, errors = [], 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            started = time.perf_counter()
+            response = await request(client)
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code >= 400:
+                errors += 1
+
+    queries = db_queries.value()
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(statistics.median(latencies), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "max_ms": round(max(latencies), 2),
+        "queries_per_request": round((db_queries.value() - queries) / len(latencies), 2),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+async def run(args):
+    import httpx
+
+    import main
+    from bench import catalogue
+
+    scenarios = Scenarios(main, catalogue, args, random.Random(args.seed))
+    results = {}
+    await main.app.router.startup()
+    try:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://bench") as client:
+            for name in args.scenarios:
+                request = getattr(scenarios, name)
+                requests = args.upload_requests if name == "upload" else args.requests
+                await run_scenario(client, request, min(args.warmup, requests), args.concurrency)
+                results[name] = await run_scenario(client, request, requests, args.concurrency)
+                print(format_result(name, results[name]), flush=True)
+    finally:
+        await main.app.router.shutdown()
+    return results
+
+
+def format_result(name, result):
+    return (
+        f"{name:13} {result['requests_per_second']:9.1f} req/s  p50 {result['p50_ms']:8.2f} ms  "
+        f"p99 {result['p99_ms']:8.2f} ms  {result['queries_per_request']:6.2f} queries/req  "
+        f"{result['errors']} errors  rss {result['peak_rss_mb']:.0f} MB"
+    )
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\nagainst {baseline_path} ({baseline['meta'].get('commit')})")
+    for name, result in results.items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+        changes = []
+        for key, label in (("requests_per_second", "req/s"), ("p99_ms", "p99"), ("queries_per_request", "queries")):
+            if before[key]:
+                changes.append(f"{label} {(result[key] - before[key]) / before[key] * 100:+6.1f}%")
+            else:
+                changes.append(f"{label} {before[key]} -> {result[key]}")
+        print(f"{name:13} " + "  ".join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", help="empty throwaway database, defaults to a temporary SQLite file")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the async database driver")
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--songs", type=int, default=2000)
+    parser.add_argument("--favs-per-user", type=float, default=20)
+    parser.add_argument("--popularity", type=float, default=1.1, help="Zipf exponent of song popularity")
+    parser.add_argument("--audio-kb", type=int, default=256)
+    parser.add_argument("--upload-kb", type=int, default=256)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--upload-requests", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=SCENARIOS)
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier run to compare against")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios {', '.join(sorted(unknown))}, pick from {', '.join(SCENARIOS)}")
+
+    workdir = tempfile.mkdtemp(prefix="songs-bench-")
+    try:
+        configure(args, workdir)
+        catalogue = seed_catalogue(args)
+        print(f"seeded {catalogue['users']} users, {catalogue['songs']} songs, {catalogue['favs']} favs in {catalogue['seconds']}s")
+        results = asyncio.run(run(args))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "database": os.environ["DATABASE_URL"].split(":", 1)[0],
+            "async": args.use_async,
+            "catalogue": catalogue,
+            "options": {key: value for key, value in vars(args).items() if key not in ("output", "compare", "database_url")},
+        },
+        "scenarios": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Measures requests per second on the read endpoints at a fixed concurrency.
+
+Run it against a live server started with DB_ASYNC=false and again with
+DB_ASYNC=true to compare the threadpool and async database paths:
+
+    python bench/throughput.py --url http://localhost:8000 --concurrency 64
+"""
+import argparse
+import statistics
+import threading
+import time
+import urllib.request
+
+PATHS = ["/songs/", "/songs/search?q=a", "/info"]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+
+def client_loop(url, path, headers, deadline, latencies, errors):
+    request = urllib.request.Request(f"{url}{path}", headers=headers)
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        try:
+            urllib.request.urlopen(request).read()
+        except Exception:
+            errors.append(1)
+            continue
+        latencies.append((time.perf_counter() - started) * 1000)
+
+
+def run(url, path, headers, concurrency, seconds):
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+    clients = [
+        threading.Thread(target=client_loop, args=(url, path, headers, deadline, latencies, errors), daemon=True)
+        for _ in range(concurrency)
+    ]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    if not latencies:
+        print(f"{path:>20}: every request failed")
+        return
+    print(
+        f"{path:>20}: {len(latencies) / seconds:8.1f} req/s "
+        f"p50={statistics.median(latencies):7.1f}ms p99={percentile(latencies, 99):7.1f}ms errors={len(errors)}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--token", help="bearer token, skips the anonymous response cache")
+    parser.add_argument("--concurrency", type=int, default=64, help="concurrent clients")
+    parser.add_argument("--seconds", type=float, default=10, help="duration of each endpoint run")
+    parser.add_argument("--path", action="append", help="endpoint to measure, repeatable")
+    args = parser.parse_args()
+
+    headers = {"Authorization": f"Bearer {args.token}"} if args.token else {}
+    for path in args.path or PATHS:
+        run(args.url, path, headers, args.concurrency, args.seconds)
+
+
+if __name__ == "__main__":
+    main()
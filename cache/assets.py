@@ -0,0 +1,57 @@
+import os
+import time
+
+from typing import NamedTuple
+
+from .lru import TTLCache
+
+# song id -> {asset: blob name}. Asset names never change for a song, the TTL
+# only bounds how long other workers keep serving a song deleted elsewhere.
+song_assets = TTLCache(
+    maxsize=int(os.environ.get("ASSET_CACHE_SIZE", 65536)),
+    ttl=float(os.environ.get("ASSET_CACHE_TTL_SECONDS", 3600)),
+)
+
+# How long an audio variant found missing is taken as absent. The worker that
+# produces it forgets this at once, the others when it runs out.
+ABSENT_TTL = float(os.environ.get("ASSET_CACHE_ABSENT_TTL_SECONDS", 60))
+
+MISSING = object()
+
+
+class _Absent(NamedTuple):
+    until: float
+
+
+def get_asset(song_id: int, asset: str):
+    """
+    Returns the cached blob name, None for a known empty chart slot or
+    absent variant, or MISSING when the database has to be asked.
+    """
+    names = song_assets.get(song_id)
+    if names is None:
+        return MISSING
+    name = names.get(asset, MISSING)
+    if isinstance(name, _Absent):
+        return None if name.until > time.monotonic() else MISSING
+    return name
+
+
+def remember_asset(song_id: int, asset: str, name):
+    names = song_assets.get(song_id)
+    if names is None:
+        song_assets.set(song_id, {asset: name})
+    else:
+        names[asset] = name
+
+
+def remember_absent(song_id: int, asset: str):
+    remember_asset(song_id, asset, _Absent(time.monotonic() + ABSENT_TTL))
+
+
+def remember_song_assets(song_id: int, **names):
+    song_assets.set(song_id, names)
+
+
+def forget_song_assets(song_id: int):
+    song_assets.pop(song_id)
@@ -0,0 +1,38 @@
+import threading
+
+from collections import Counter
+from typing import Dict, Tuple
+
+
+class DownloadCounter:
+    """
+    Download counts buffered in memory and written to the database in batches
+    by a periodic flush, so downloads never wait on an UPDATE. Anything not
+    flushed yet is lost if the process dies, which bounds the loss to one
+    flush interval.
+    """
+
+    def __init__(self):
+        self._counts: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def hit(self, song_id: int, kind: str):
+        with self._lock:
+            self._counts[(song_id, kind)] += 1
+
+    def drain(self) -> Dict[Tuple[int, str], int]:
+        with self._lock:
+            counts, self._counts = self._counts, Counter()
+        return dict(counts)
+
+    def restore(self, counts: Dict[Tuple[int, str], int]):
+        # a failed flush puts its counts back for the next one
+        with self._lock:
+            self._counts.update(counts)
+
+    def pending(self) -> int:
+        with self._lock:
+            return sum(self._counts.values())
+
+
+download_counter = DownloadCounter()
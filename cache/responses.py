@@ -0,0 +1,129 @@
+import json
+import os
+import threading
+
+from typing import Optional
+from urllib.parse import urlencode
+
+from fastapi import Request, Response
+
+from response.fastjson import FastJSONResponse
+
+from .lru import TTLCache
+
+
+class ResponseCacheBackend:
+    """
+    Storage for serialized responses plus the catalogue version that prefixes
+    every key. Bumping the version orphans all stored entries at once.
+    """
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes):
+        raise NotImplementedError
+
+    def version(self) -> int:
+        raise NotImplementedError
+
+    def bump_version(self):
+        raise NotImplementedError
+
+
+class LocalResponseCacheBackend(ResponseCacheBackend):
+    """
+    Per process cache. Other workers only see a bump once their entries expire.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._entries = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._entries.get(key)
+
+    def set(self, key: str, value: bytes):
+        self._entries.set(key, value)
+
+    def version(self) -> int:
+        return self._version
+
+    def bump_version(self):
+        with self._lock:
+            self._version += 1
+        self._entries.clear()
+
+
+class RedisResponseCacheBackend(ResponseCacheBackend):
+    """
+    Cache shared by every worker. Needs the redis package.
+    """
+
+    VERSION_KEY = "response-cache:version"
+
+    def __init__(self, url: str, ttl: float):
+        import redis
+
+        self._redis = redis.Redis.from_url(url)
+        self._ttl = int(ttl)
+
+    def get(self, key: str) -> Optional[bytes]:
+        return self._redis.get(f"response-cache:{key}")
+
+    def set(self, key: str, value: bytes):
+        self._redis.set(f"response-cache:{key}", value, ex=self._ttl)
+
+    def version(self) -> int:
+        return int(self._redis.get(self.VERSION_KEY) or 0)
+
+    def bump_version(self):
+        self._redis.incr(self.VERSION_KEY)
+
+
+class ResponseCache:
+    """
+    Keeps anonymous catalogue responses as ready to send JSON bytes, keyed by
+    path and query string under the catalogue version.
+
+    get() must be called before the database is read. The key it looks up,
+    version included, is the one store() later writes to, so a response
+    built from data read before a change is filed under the version the
+    change bumped away from and never served.
+    """
+
+    def __init__(self, backend: ResponseCacheBackend):
+        self.backend = backend
+
+    def _key(self, request: Request) -> str:
+        query = urlencode(sorted(request.query_params.multi_items()))
+        return f"{self.backend.version()}:{request.url.path}?{query}"
+
+    def get(self, request: Request) -> Optional[Response]:
+        key = request.state.response_cache_key = self._key(request)
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        headers, _, body = entry.partition(b"\n")
+        return Response(body, media_type="application/json", headers=json.loads(headers))
+
+    def store(self, request: Request, content, headers: Optional[dict] = None) -> Response:
+        response = FastJSONResponse(content, headers=headers)
+        key = getattr(request.state, "response_cache_key", None) or self._key(request)
+        self.backend.set(key, json.dumps(headers or {}).encode() + b"\n" + response.body)
+        return response
+
+    def invalidate(self):
+        self.backend.bump_version()
+
+
+def _backend() -> ResponseCacheBackend:
+    ttl = float(os.environ.get("RESPONSE_CACHE_TTL_SECONDS", 60))
+    url = os.environ.get("RESPONSE_CACHE_URL")
+    if url:
+        return RedisResponseCacheBackend(url, ttl)
+    return LocalResponseCacheBackend(int(os.environ.get("RESPONSE_CACHE_SIZE", 1024)), ttl)
+
+
+response_cache = ResponseCache(_backend())
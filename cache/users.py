@@ -0,0 +1,15 @@
+import os
+
+from .lru import TTLCache
+
+# Resolved users keyed by token subject. Entries are short lived because other
+# worker processes cannot see the invalidations done by this one.
+user_cache = TTLCache(
+    maxsize=int(os.environ.get("USER_CACHE_SIZE", 4096)),
+    ttl=float(os.environ.get("USER_CACHE_TTL_SECONDS", 30)),
+)
+
+
+def invalidate_user(*usernames: str):
+    for username in usernames:
+        user_cache.pop(username)
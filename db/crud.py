@@ -1,11 +1,18 @@
-from distutils.command.upload import upload
-from fcntl import F_SEAL_SEAL
-from pyexpat import model
+from sqlalchemy import and_, case, func, select
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 
-from typing import Optional
+import re
 
-from . import models, schemas
+from datetime import date
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import models, schemas, search
+from cache import assets
+from cache.responses import response_cache
+from cache.users import invalidate_user
+from files.blobs import StoredBlob, blob_store
 
 
 def get_user(db: Session, user_id: int):
@@ -16,8 +23,11 @@ def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 
-def get_users(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.User).offset(skip).limit(limit).all()
+def get_users(db: Session, skip: int = 0, limit: int = 100, after: Optional[int] = None):
+    query = db.query(models.User).order_by(models.User.id)
+    if after is not None:
+        query = query.filter(models.User.id > after)
+    return query.offset(skip).limit(limit).all()
 
 
 def create_user(db: Session, user: schemas.UserCreate):
@@ -29,107 +39,632 @@ def create_user(db: Session, user: schemas.UserCreate):
 
 def update_user(db: Session, user: schemas.UserUpdate, current_user: models.User):
     db_user: models.User = get_user(db, current_user.id)
+    invalidate_user(db_user.username)
     db_user.username = user.username if user.username is not None else db_user.username
     db_user.hashed_password = user.password if user.password is not None else db_user.hashed_password
     db.commit()
+    db.refresh(db_user)
+    return db_user
 
 def delete_user(db: Session, user_id: int):
     db_user = get_user(db, user_id)
+    invalidate_user(db_user.username)
+    # their songs lose the uploader, locked before the user like every writer does
+    uploaded = [song_id for song_id, in db.query(models.Song.id).filter(
+        models.Song.uploader == user_id
+    ).order_by(models.Song.id).with_for_update()]
     db.delete(db_user)
+    db.flush()
+    db.query(models.CatalogueChange).filter(models.CatalogueChange.user_id == user_id).delete(synchronize_session=False)
+    _log_changes(db, uploaded)
     db.commit()
+    response_cache.invalidate()
+    collect_orphan_blobs(db)
 
 def get_song(db: Session, song_id: int):
     return db.query(models.Song).filter(models.Song.id == song_id).first()
 
-def get_songs(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Song).offset(skip).limit(limit).all()
+def get_songs(db: Session, user: Optional[schemas.User] = None, skip: int = 0, limit: int = 100, after: Optional[int] = None):
+    return _list_songs(db, user, skip=skip, limit=limit, after=after)
 
-def get_song_auth(db: Session, song_id: int, user: schemas.User):
-    song: models.Song = db.query(models.Song).filter(models.Song.id == song_id).first()
-    song_schema = schemas.Song(
-        id=song.id,
-        song_name=song.song_name,
-        author=song.author,
-        music=song.music,
-        easy_diff=song.easy_diff,
-        normal_diff=song.normal_diff,
-        hard_diff=song.hard_diff,
-        song_art=song.song_art,
-        uploader=song.uploader
+def get_songs_uploaded_by(db: Session, user_id: int, skip: int = 0, limit: int = 100):
+    return _list_songs(db, None, skip=skip, limit=limit, condition=models.Song.uploader == user_id)
+
+def get_songs_faved_by(db: Session, user_id: int, skip: int = 0, limit: int = 100):
+    faved = select(models.association_table.c.song_id).where(models.association_table.c.user_id == user_id)
+    return _list_songs(db, None, skip=skip, limit=limit, condition=models.Song.id.in_(faved))
+
+SONG_LIST_COLUMNS = (
+    models.Song.id,
+    models.Song.song_name,
+    models.Song.author,
+    models.Song.music,
+    models.Song.uploader,
+    models.Song.jacket,
+    models.Song.jacket_artist,
+    models.Song.audio_status,
+)
+NO_CHART = (None, None, None)
+
+def _list_songs(db: Session, user: Optional[schemas.User], skip: int = 0, limit: int = 100, after: Optional[int] = None, condition=None):
+    """
+    A page of songs as plain dicts shaped like schemas.Song, read as tuples so
+    no ORM objects or pydantic models are built for listings. isFaved is only
+    filled in for a user.
+    """
+    query = db.query(*SONG_LIST_COLUMNS)
+    if user is not None:
+        query = query.add_columns(models.association_table.c.user_id.isnot(None)).outerjoin(
+            models.association_table,
+            and_(
+                models.association_table.c.song_id == models.Song.id,
+                models.association_table.c.user_id == user.id
+            )
+        )
+    if condition is not None:
+        query = query.filter(condition)
+    if after is not None:
+        query = query.filter(models.Song.id > after)
+    rows = query.order_by(models.Song.id).offset(skip).limit(limit).all()
+
+    charts = {}
+    if rows:
+        chart_rows = db.query(
+            models.Chart.song_id, models.Chart.level, models.Chart.difficulty, models.Chart.blob, models.Chart.charter
+        ).filter(models.Chart.song_id.in_([row[0] for row in rows]))
+        for song_id, level, difficulty, blob, charter in chart_rows:
+            charts.setdefault(song_id, {})[level] = (difficulty, blob, charter)
+
+    songs = []
+    for row in rows:
+        song_charts = charts.get(row[0], {})
+        songs.append({
+            "song_name": row[1],
+            "author": row[2],
+            "music": row[3],
+            "easy_diff": song_charts.get("easy", NO_CHART),
+            "normal_diff": song_charts.get("normal", NO_CHART),
+            "hard_diff": song_charts.get("hard", NO_CHART),
+            "song_art": (row[5], row[6]),
+            "uploader": row[4],
+            "id": row[0],
+            "isFaved": row[8] if user is not None else None,
+            "audio_status": row[7],
+        })
+    return songs
+
+def _query_songs_faved_by(db: Session, user_id: int):
+    # LEFT JOIN against favs so the fav flag of every song comes back in the same row
+    is_faved = models.association_table.c.user_id.isnot(None).label("is_faved")
+    return db.query(models.Song, is_faved).outerjoin(
+        models.association_table,
+        and_(
+            models.association_table.c.song_id == models.Song.id,
+            models.association_table.c.user_id == user_id
+        )
     )
-    song_schema.isFaved = True in [song_ls.id == song.id for song_ls in get_user(db, user.id).songs_faved]
+
+def _song_with_fav(song: models.Song, is_faved: bool):
+    song_schema = schemas.Song.from_orm(song)
+    song_schema.isFaved = is_faved
     return song_schema
 
-def get_songs_auth(db: Session, user: schemas.User, skip: int = 0, limit: int = 100):
-    songs = db.query(models.Song).offset(skip).limit(limit).all()
-    songs_s = []
-    for song in songs:
-        song_schema = schemas.Song(
-            id=song.id,
-            song_name=song.song_name,
-            author=song.author,
-            music=song.music,
-            easy_diff=song.easy_diff,
-            normal_diff=song.normal_diff,
-            hard_diff=song.hard_diff,
-            song_art=song.song_art,
-            uploader=song.uploader
-        )
-        song_schema.isFaved = True in [song_ls.id == song.id for song_ls in get_user(db, user.id).songs_faved]
-        songs_s.append(song_schema)
-    return songs_s
+def get_songs_by_ids(db: Session, song_ids: Iterable[int]):
+    return db.query(models.Song).filter(models.Song.id.in_(list(song_ids))).order_by(models.Song.id).all()
+
+def get_song_auth(db: Session, song_id: int, user: schemas.User):
+    row = _query_songs_faved_by(db, user.id).filter(models.Song.id == song_id).first()
+    if row is None:
+        return None
+    return _song_with_fav(*row)
+
+
+def _blob_name(blob: Optional[StoredBlob]):
+    return blob.name if blob is not None else None
 
+def search_songs(
+    db: Session,
+    query: Optional[str] = None,
+    level: Optional[schemas.Difficulty] = None,
+    difficulty: Optional[str] = None,
+    charter: Optional[str] = None,
+    min_difficulty: Optional[float] = None,
+    max_difficulty: Optional[float] = None,
+    user: Optional[schemas.User] = None,
+    skip: int = 0,
+    limit: int = 100
+):
+    songs = _query_songs_faved_by(db, user.id) if user else db.query(models.Song)
+    order = [models.Song.id]
+    if query is not None:
+        terms = search.search_terms(query)
+        if not terms:
+            return []
+        matches = search.match_songs(db, terms)
+        songs = songs.join(matches, matches.c.song_id == models.Song.id)
+        order = [matches.c.rank.desc(), models.Song.id]
+    chart_filters = [models.Chart.blob.isnot(None)]
+    # all of these have to match on the same chart
+    if level is not None:
+        chart_filters.append(models.Chart.level == level.value)
+    if difficulty is not None:
+        chart_filters.append(models.Chart.difficulty == difficulty)
+    if charter is not None:
+        chart_filters.append(func.lower(models.Chart.charter) == charter.lower())
+    if min_difficulty is not None:
+        chart_filters.append(models.Chart.difficulty_value >= min_difficulty)
+    if max_difficulty is not None:
+        chart_filters.append(models.Chart.difficulty_value <= max_difficulty)
+    if len(chart_filters) > 1:
+        songs = songs.filter(models.Song.charts.any(and_(*chart_filters)))
+    rows = songs.order_by(*order).offset(skip).limit(limit).all()
+    if user:
+        return [_song_with_fav(song, is_faved) for song, is_faved in rows]
+    return rows
 
-def create_song(db: Session, song: schemas.SongCreateAPI, audio: str, art: str, easy: Optional[str] = None, normal: Optional[str]= None, hard: Optional[str] = None):
+
+def difficulty_value(difficulty: Optional[str]) -> Optional[float]:
+    match = re.match(r"\s*(\d+(?:\.\d+)?)", difficulty or "")
+    return float(match.group(1)) if match else None
+
+def _chart(level: str, difficulty: Optional[str], charter: Optional[str], blob: Optional[StoredBlob]):
+    return models.Chart(
+        level=level,
+        difficulty=difficulty,
+        difficulty_value=difficulty_value(difficulty),
+        charter=charter,
+        blob=_blob_name(blob)
+    )
+
+def create_song(db: Session, song: schemas.SongCreateAPI, audio: StoredBlob, art: StoredBlob, easy: Optional[StoredBlob] = None, normal: Optional[StoredBlob]= None, hard: Optional[StoredBlob] = None):
     db_song = models.Song(
         song_name=song.song_name,
         author=song.author,
-        music=audio,
-        easy_diff=[
-            song.easy_diff_text,
-            easy,
-            song.easy_diff_charter
-            ],
-        normal_diff=[
-            song.normal_diff_text,
-            normal,
-            song.normal_diff_charter
-            ],
-        hard_diff=[
-            song.hard_diff_text,
-            hard,
-            song.hard_diff_charter
-            ],
-        song_art=[art, song.song_art_artist],
+        music=audio.name,
+        charts=[
+            _chart("easy", song.easy_diff_text, song.easy_diff_charter, easy),
+            _chart("normal", song.normal_diff_text, song.normal_diff_charter, normal),
+            _chart("hard", song.hard_diff_text, song.hard_diff_charter, hard)
+        ],
+        jacket=art.name,
+        jacket_artist=song.song_art_artist,
         uploader=song.uploader
     )
     db.add(db_song)
+    db.flush()
+    acquire_blobs(db, [blob for blob in (audio, art, easy, normal, hard) if blob is not None])
+    search.index_song(db, db_song)
+    _bump_user_counts(db, models.User.id == db_song.uploader, uploaded_count=1)
+    _log_changes(db, [db_song.id])
+    _bump_total_songs(db, 1)
     db.commit()
+    response_cache.invalidate()
     db.refresh(db_song)
+    assets.remember_song_assets(
+        db_song.id,
+        audio=audio.name,
+        jacket=art.name,
+        easy=_blob_name(easy),
+        normal=_blob_name(normal),
+        hard=_blob_name(hard)
+    )
     return db_song
 
-def get_total_songs(db: Session):
-    result = db.execute("select count(id) from songs")
-    return result.first()[0]
+SONG_ASSET_COLUMNS = {
+    "audio": models.Song.music,
+    "jacket": models.Song.jacket,
+}
 
-def fav_song(db: Session, user_id: int, song_id: int):
-    try:
-        db_user: models.User = get_user(db, user_id)
-        db_user.songs_faved.append(get_song(db, song_id))
-        db.commit()
-    except:
+def get_song_asset(db: Session, song_id: int, asset: str):
+    """
+    Blob name of one asset of a song, None if the song does not exist or has
+    nothing in that slot. Served from the in-memory map when possible and
+    otherwise by selecting only the one column.
+    """
+    name = assets.get_asset(song_id, asset)
+    if name is not assets.MISSING:
+        return name
+    if asset in SONG_ASSET_COLUMNS:
+        row = db.query(SONG_ASSET_COLUMNS[asset]).filter(models.Song.id == song_id).first()
+    elif asset.startswith("audio."):
+        row = db.query(models.AudioVariant.blob).filter(
+            models.AudioVariant.song_id == song_id, models.AudioVariant.format == asset[len("audio."):]
+        ).first()
+        if row is None:
+            # the variant may still be on its way, add_audio_variants forgets this
+            assets.remember_absent(song_id, asset)
+            return None
+    else:
+        row = db.query(models.Chart.blob).filter(models.Chart.song_id == song_id, models.Chart.level == asset).first()
+    if row is None:
+        return None
+    name = row[0]
+    assets.remember_asset(song_id, asset, name)
+    return name
+
+def get_song_audio(db: Session, song_id: int, formats: List[str]):
+    """
+    Format and blob name of the first of formats the song has, falling back
+    to the uploaded wav. None if the song does not exist.
+    """
+    for audio_format in formats:
+        if audio_format == schemas.AudioFormat.WAV:
+            break
+        name = get_song_asset(db, song_id, f"audio.{audio_format}")
+        if name is not None:
+            return audio_format, name
+    name = get_song_asset(db, song_id, "audio")
+    return (schemas.AudioFormat.WAV.value, name) if name is not None else None
+
+def get_audio_variants(db: Session, song_id: int):
+    rows = db.query(models.AudioVariant.format, models.AudioVariant.blob).filter(models.AudioVariant.song_id == song_id)
+    return {audio_format: blob for audio_format, blob in rows}
+
+def get_songs_awaiting_audio(db: Session):
+    rows = db.query(models.Song.id).filter(models.Song.audio_status == "pending").order_by(models.Song.id)
+    return [song_id for song_id, in rows]
+
+def set_audio_status(db: Session, song_id: int, status: str, expected: Optional[str] = None):
+    """
+    Changes the audio status of a song, only if it is expected when given.
+    Returns whether it changed.
+    """
+    query = db.query(models.Song).filter(models.Song.id == song_id)
+    if expected is not None:
+        query = query.filter(models.Song.audio_status == expected)
+    updated = query.update({models.Song.audio_status: status}, synchronize_session=False)
+    if updated:
+        _log_changes(db, [song_id])
+    db.commit()
+    if updated:
+        response_cache.invalidate()
+    return updated > 0
+
+def claim_audio_job(db: Session, song_id: int):
+    """
+    Moves a pending song to processing. Only one of the workers that queued
+    the song at startup gets True and transcodes it.
+    """
+    return set_audio_status(db, song_id, "processing", expected="pending")
+
+def requeue_interrupted_audio_jobs(db: Session):
+    """
+    Puts songs left processing by a worker that stopped back to pending, to
+    be queued on the next start. Only safe while no worker runs.
+    """
+    updated = db.query(models.Song).filter(models.Song.audio_status == "processing").update(
+        {models.Song.audio_status: "pending"}, synchronize_session=False
+    )
+    db.commit()
+    return updated
+
+def add_audio_variants(db: Session, song_id: int, variants: Dict[str, StoredBlob]):
+    """
+    Attaches transcoded variants to a song and marks its audio ready. Returns
+    False when the song was deleted meanwhile, the blobs are then left to the caller.
+    """
+    if db.query(models.Song.id).filter(models.Song.id == song_id).with_for_update().first() is None:
+        db.rollback()
         return False
+    replaced = get_audio_variants(db, song_id)
+    released = [replaced[audio_format] for audio_format in variants if audio_format in replaced]
+    # released and acquired blobs together, in one pass by name
+    _lock_blobs(db, released + [blob.name for blob in variants.values()])
+    release_blobs(db, released)
+    acquire_blobs(db, variants.values())
+    for audio_format, blob in variants.items():
+        db.merge(models.AudioVariant(song_id=song_id, format=audio_format, blob=blob.name))
+    set_audio_status(db, song_id, "ready")
+    assets.forget_song_assets(song_id)
+    if replaced:
+        collect_orphan_blobs(db)
     return True
-    
+
+STATS_ID = 1
+
+# Writers lock rows in this order so concurrent ones cannot deadlock: the
+# song, its blobs by name, users by id and the store_stats row last.
+
+def get_total_songs(db: Session):
+    return db.query(models.StoreStats.total_songs).filter(models.StoreStats.id == STATS_ID).scalar()
+
+def _bump_total_songs(db: Session, delta: int):
+    db.query(models.StoreStats).filter(models.StoreStats.id == STATS_ID).update(
+        {models.StoreStats.total_songs: models.StoreStats.total_songs + delta}, synchronize_session=False
+    )
+
+def _lock_users(db: Session, condition):
+    db.query(models.User.id).filter(condition).order_by(models.User.id).with_for_update().all()
+
+def _bump_user_counts(db: Session, condition, **deltas: int):
+    db.query(models.User).filter(condition).update(
+        {getattr(models.User, column): getattr(models.User, column) + delta for column, delta in deltas.items()},
+        synchronize_session=False
+    )
+
+def reconcile_stats(db: Session):
+    """
+    Recomputes every maintained counter from the tables they summarize.
+    """
+    db.query(models.User).update({
+        models.User.uploaded_count: select(func.count(models.Song.id)).where(
+            models.Song.uploader == models.User.id
+        ).scalar_subquery(),
+        models.User.faved_count: select(func.count()).select_from(models.association_table).where(
+            models.association_table.c.user_id == models.User.id
+        ).scalar_subquery(),
+    }, synchronize_session=False)
+    total_songs = db.query(func.count(models.Song.id)).scalar()
+    table = models.StoreStats.__table__
+    db.execute(_insert(db, table).values(id=STATS_ID, total_songs=total_songs).on_conflict_do_update(
+        index_elements=[table.c.id],
+        set_={"total_songs": total_songs}
+    ))
+    db.commit()
+
+def record_downloads(db: Session, counts: Dict[Tuple[int, str], int], day: date):
+    """
+    Adds buffered download counts, keyed by (song id, "audio" or "charts"),
+    to the day's totals with one upsert.
+    """
+    per_song = {}
+    for (song_id, kind), count in counts.items():
+        per_song.setdefault(song_id, {"audio": 0, "charts": 0})[kind] += count
+    # songs deleted after their downloads were counted are dropped
+    existing = _existing_songs(db, per_song)
+    rows = [{"song_id": song_id, "day": day, **kinds} for song_id, kinds in per_song.items() if song_id in existing]
+    if rows:
+        table = models.SongDownloads.__table__
+        stmt = _insert(db, table).values(rows)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.song_id, table.c.day],
+            set_={"audio": table.c.audio + stmt.excluded.audio, "charts": table.c.charts + stmt.excluded.charts}
+        ))
+    db.commit()
+
+def get_songs_ranked(db: Session, song_ids: List[int], user: Optional[schemas.User] = None):
+    """
+    Songs in the order of song_ids, skipping the ones that no longer exist.
+    """
+    if not song_ids:
+        return []
+    songs = {song["id"]: song for song in _list_songs(db, user, limit=len(song_ids), condition=models.Song.id.in_(song_ids))}
+    return [songs[song_id] for song_id in song_ids if song_id in songs]
+
+def get_catalogue_version(db: Session):
+    return db.query(models.StoreStats.catalogue_version).filter(models.StoreStats.id == STATS_ID).scalar() or 0
+
+def _log_changes(db: Session, song_ids: List[int], user_id: Optional[int] = None, deleted: bool = False):
+    """
+    Records that song_ids changed, for everyone or only for user_id, under a
+    new catalogue version shared by the whole transaction's batch. Older
+    entries of the same songs and scope are dropped, a deletion drops them in
+    every scope.
+    """
+    if not song_ids:
+        return
+    # the row lock taken here makes concurrent writers commit their versions in order
+    db.query(models.StoreStats).filter(models.StoreStats.id == STATS_ID).update(
+        {models.StoreStats.catalogue_version: models.StoreStats.catalogue_version + 1}, synchronize_session=False
+    )
+    version = get_catalogue_version(db)
+    superseded = db.query(models.CatalogueChange).filter(models.CatalogueChange.song_id.in_(song_ids))
+    if not deleted:
+        superseded = superseded.filter(
+            models.CatalogueChange.user_id == user_id if user_id is not None else models.CatalogueChange.user_id.is_(None)
+        )
+    superseded.delete(synchronize_session=False)
+    db.execute(models.CatalogueChange.__table__.insert(), [
+        {"version": version, "song_id": song_id, "user_id": user_id, "deleted": deleted} for song_id in song_ids
+    ])
+
+def get_changes(db: Session, since: int, user: Optional[schemas.User] = None, limit: int = 1000):
+    """
+    Songs added, changed or removed after version since, as seen by user.
+    At most about limit songs are returned, more is set when the returned
+    version is not the latest yet and the client should ask again.
+    """
+    scope = models.CatalogueChange.user_id.is_(None)
+    if user is not None:
+        scope = scope | (models.CatalogueChange.user_id == user.id)
+    # every version up to the counter has committed once the counter is visible
+    current = get_catalogue_version(db)
+    query = db.query(
+        models.CatalogueChange.version, models.CatalogueChange.song_id, models.CatalogueChange.deleted
+    ).filter(scope, models.CatalogueChange.version > since).order_by(models.CatalogueChange.version)
+    rows = query.filter(models.CatalogueChange.version <= current).limit(limit + 1).all()
+    more = len(rows) > limit
+    version = current
+    if more:
+        # a batch shares its version and is never split between two pages
+        version = rows[limit - 1].version
+        rows = query.filter(models.CatalogueChange.version <= version).all()
+
+    latest = {}
+    for row in rows:
+        latest[row.song_id] = row.deleted
+    changed = [song_id for song_id, deleted in latest.items() if not deleted]
+    songs = _list_songs(db, user, limit=len(changed), condition=models.Song.id.in_(changed)) if changed else []
+    found = {song["id"] for song in songs}
+    removed = sorted(song_id for song_id in latest if song_id not in found)
+    return {"version": version, "songs": songs, "removed": removed, "more": more}
+
+def init_stats(db: Session):
+    if db.query(models.StoreStats).filter(models.StoreStats.id == STATS_ID).first() is None:
+        reconcile_stats(db)
+
+def _faved_among(db: Session, user_id: int, song_ids: Iterable[int]):
+    table = models.association_table
+    rows = db.execute(select(table.c.song_id).where(table.c.user_id == user_id, table.c.song_id.in_(list(song_ids))))
+    return {song_id for song_id, in rows}
+
+def _existing_songs(db: Session, song_ids: Iterable[int]):
+    return {song_id for song_id, in db.query(models.Song.id).filter(models.Song.id.in_(list(song_ids)))}
+
+def update_favs(db: Session, user_id: int, add: Iterable[int] = (), remove: Iterable[int] = ()):
+    """
+    Favs and unfavs many songs with one INSERT ... ON CONFLICT DO NOTHING and
+    one DELETE, and returns what happened to every id. add and remove must
+    not share ids.
+    """
+    table = models.association_table
+    add, remove = list(dict.fromkeys(add)), list(dict.fromkeys(remove))
+    results = {}
+    if add:
+        existing = _existing_songs(db, add)
+        faved = _faved_among(db, user_id, add)
+        new = [song_id for song_id in add if song_id in existing and song_id not in faved]
+        for song_id in add:
+            if song_id not in existing:
+                results[song_id] = schemas.FavChange.NOT_FOUND
+            else:
+                results[song_id] = schemas.FavChange.ALREADY_FAVED if song_id in faved else schemas.FavChange.FAVED
+        if new:
+            inserted = db.execute(
+                _insert(db, table).values([{"user_id": user_id, "song_id": song_id} for song_id in new]).on_conflict_do_nothing()
+            ).rowcount
+            _bump_user_counts(db, models.User.id == user_id, faved_count=inserted)
+            _log_changes(db, new, user_id=user_id)
+    if remove:
+        faved = _faved_among(db, user_id, remove)
+        for song_id in remove:
+            results[song_id] = schemas.FavChange.UNFAVED if song_id in faved else schemas.FavChange.NOT_FAVED
+        if faved:
+            deleted = db.execute(
+                table.delete().where(table.c.user_id == user_id, table.c.song_id.in_(list(faved)))
+            ).rowcount
+            _bump_user_counts(db, models.User.id == user_id, faved_count=-deleted)
+            _log_changes(db, list(faved), user_id=user_id)
+    db.commit()
+    return results
+
+def replace_favs(db: Session, user_id: int, song_ids: Iterable[int]):
+    """
+    Makes song_ids the user's whole favs list.
+    """
+    song_ids = list(dict.fromkeys(song_ids))
+    table = models.association_table
+    faved = {song_id for song_id, in db.execute(select(table.c.song_id).where(table.c.user_id == user_id))}
+    keep = set(song_ids)
+    return update_favs(db, user_id, add=song_ids, remove=[song_id for song_id in faved if song_id not in keep])
+
+def fav_song(db: Session, user_id: int, song_id: int):
+    return update_favs(db, user_id, add=[song_id])[song_id] == schemas.FavChange.FAVED
+
 def unfav_song(db: Session, user_id: int, song_id: int):
-    db_user: models.User = get_user(db, user_id)
-    try:
-        db_user.songs_faved.remove(get_song(db, song_id))
-        db.commit()
-    except:
-        return False
-    return True
+    return update_favs(db, user_id, remove=[song_id])[song_id] == schemas.FavChange.UNFAVED
 
 def delete_song(db: Session, song_id: int):
-    db.delete(get_song(db, song_id))
-    db.commit()
\ No newline at end of file
+    db_song = db.query(models.Song).filter(models.Song.id == song_id).with_for_update().first()
+    release_blobs(db, song_blob_names(db_song) + list(get_audio_variants(db, song_id).values()))
+    db.query(models.AudioVariant).filter(models.AudioVariant.song_id == song_id).delete(synchronize_session=False)
+    search.unindex_song(db, song_id)
+    # the favs rows go away with the song
+    fav_users = select(models.association_table.c.user_id).where(models.association_table.c.song_id == song_id)
+    _lock_users(db, models.User.id.in_(fav_users) | (models.User.id == db_song.uploader))
+    _bump_user_counts(db, models.User.id.in_(fav_users), faved_count=-1)
+    _bump_user_counts(db, models.User.id == db_song.uploader, uploaded_count=-1)
+    db.execute(models.association_table.delete().where(models.association_table.c.song_id == song_id))
+    db.query(models.SongDownloads).filter(models.SongDownloads.song_id == song_id).delete(synchronize_session=False)
+    _log_changes(db, [song_id], deleted=True)
+    _bump_total_songs(db, -1)
+    db.delete(db_song)
+    db.commit()
+    response_cache.invalidate()
+    assets.forget_song_assets(song_id)
+    collect_orphan_blobs(db)
+
+def song_blob_names(song: models.Song) -> List[str]:
+    names = [song.music, song.song_art[0], song.easy_diff[1], song.normal_diff[1], song.hard_diff[1]]
+    return [name for name in names if name is not None]
+
+def _insert(db: Session, table):
+    # upserts are spelled the same on both dialects but live in different modules
+    if db.get_bind().dialect.name == "sqlite":
+        return sqlite.insert(table)
+    return postgresql.insert(table)
+
+def _released(leases):
+    # never below zero, a lease is given back at most once
+    return case((leases > 0, leases - 1), else_=0)
+
+def lease_blob(db: Session, blob: StoredBlob):
+    """
+    Records, before the file of blob is put in place, that an upload is about
+    to reference it. Leased blobs are never collected, so the file cannot be
+    removed by a failed upload or a collection of the same content while the
+    upload is still on its way to committing its song.
+    """
+    table = models.Blob.__table__
+    stmt = _insert(db, table).values(name=blob.name, kind=blob.kind, size=blob.size, refcount=0, leases=1)
+    # waits for a collection that holds the row lock and is removing the old file
+    db.execute(stmt.on_conflict_do_update(
+        index_elements=[table.c.name],
+        set_={"leases": table.c.leases + 1}
+    ))
+    db.commit()
+
+def _lock_blobs(db: Session, names: Iterable[str]):
+    db.query(models.Blob.name).filter(models.Blob.name.in_(list(names))).order_by(models.Blob.name).with_for_update().all()
+
+def acquire_blobs(db: Session, blobs: Iterable[StoredBlob]):
+    """
+    Turns the leases taken by lease_blob into references.
+    """
+    table = models.Blob.__table__
+    for blob in sorted(blobs, key=lambda blob: blob.name):
+        stmt = _insert(db, table).values(name=blob.name, kind=blob.kind, size=blob.size, refcount=1, leases=0)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.name],
+            set_={"refcount": table.c.refcount + 1, "leases": _released(table.c.leases)}
+        ))
+
+def release_blobs(db: Session, names: Iterable[str]):
+    # files stored before blobs were tracked have no row and are left alone
+    for name in sorted(names):
+        db.query(models.Blob).filter(models.Blob.name == name).update(
+            {models.Blob.refcount: models.Blob.refcount - 1}, synchronize_session=False
+        )
+
+def _collect_blobs(db: Session, candidates: Iterable[Tuple[str, str]]):
+    collected = []
+    for kind, name in candidates:
+        # the guard loses against a reference or lease taken meanwhile
+        deleted = db.query(models.Blob).filter(
+            models.Blob.name == name, models.Blob.refcount <= 0, models.Blob.leases <= 0
+        ).delete(synchronize_session=False)
+        if deleted:
+            # removed before the commit, while the deleted row stays locked and
+            # keeps lease_blob of the same content waiting
+            blob_store.delete(kind, name)
+            collected.append((kind, name))
+    db.commit()
+    return collected
+
+def collect_orphan_blobs(db: Session):
+    orphans = db.query(models.Blob.kind, models.Blob.name).filter(
+        models.Blob.refcount <= 0, models.Blob.leases <= 0
+    ).order_by(models.Blob.name).all()
+    return _collect_blobs(db, orphans)
+
+def discard_unreferenced_blobs(db: Session, blobs: Iterable[StoredBlob]):
+    """
+    Gives back the leases of a failed upload and removes its stored files
+    unless a song references them or another upload holds a lease on them.
+    """
+    blobs = sorted(blobs, key=lambda blob: blob.name)
+    for blob in blobs:
+        db.query(models.Blob).filter(models.Blob.name == blob.name).update(
+            {models.Blob.leases: _released(models.Blob.leases)}, synchronize_session=False
+        )
+    # files stored before blobs were tracked have no row and are left alone
+    return _collect_blobs(db, [(blob.kind, blob.name) for blob in blobs])
+
+def clear_blob_leases(db: Session):
+    """
+    Drops the leases of uploads that never finished, such as those of a
+    worker that was killed. Only safe while no worker runs.
+    """
+    db.query(models.Blob).filter(models.Blob.leases > 0).update({models.Blob.leases: 0}, synchronize_session=False)
+    db.commit()
+    collect_orphan_blobs(db)
\ No newline at end of file
@@ -1,21 +1,169 @@
+import contextlib
 import os
-import dotenv
-from sqlalchemy import create_engine
+import time
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
-dotenv.load_dotenv()
+import settings  # noqa: F401, loads .env before the variables below are read
+from metrics.requests import record_query, record_query_error
 
 DB_USER=os.environ.get("DB_USER")
 DB_PASSWORD=os.environ.get("DB_PASSWORD")
 DB_LOCATION=os.environ.get("DB_LOCATION")
 DB_NAME=os.environ.get("DB_NAME")
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_LOCATION}/{DB_NAME}"
+SQLALCHEMY_DATABASE_URL = os.environ.get("DATABASE_URL") or f"postgresql://{DB_USER}:{DB_PASSWORD}@{DB_LOCATION}/{DB_NAME}"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Use asyncpg/aiosqlite instead of running the sync driver on the threadpool
+DB_ASYNC = os.environ.get("DB_ASYNC", "false").lower() in ("1", "true", "yes")
 
-Base = declarative_base()
\ No newline at end of file
+# connections each worker opens at startup
+DB_POOL_WARM = int(os.environ.get("DB_POOL_WARM", 2))
+
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+
+def pool_options(url: str) -> dict:
+    if url.startswith("sqlite"):
+        # sqlite picks its own pool class, which takes none of these. Sessions
+        # are opened and closed on different threadpool threads.
+        return {"connect_args": {"check_same_thread": False}}
+    return {
+        "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+        "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+        "pool_timeout": float(os.environ.get("DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 1800)),
+        "pool_pre_ping": os.environ.get("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes"),
+    }
+
+
+def async_url(url: str) -> str:
+    scheme, _, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme.split('+')[0], scheme)}://{rest}"
+
+
+if DB_ASYNC:
+    engine = create_async_engine(async_url(SQLALCHEMY_DATABASE_URL), **pool_options(SQLALCHEMY_DATABASE_URL))
+    # objects are read after the session is done with them, nothing may lazy load then
+    SessionLocal = sessionmaker(engine, class_=AsyncSession, autocommit=False, autoflush=False, expire_on_commit=False)
+else:
+    engine = create_engine(SQLALCHEMY_DATABASE_URL, **pool_options(SQLALCHEMY_DATABASE_URL))
+    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+Base = declarative_base()
+
+
+def query_started(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def query_finished(connection, cursor, statement, parameters, context, executemany):
+    record_query(statement, time.perf_counter() - connection.info["query_started"].pop())
+
+
+def query_failed(context):
+    started = context.connection.info.get("query_started") if context.connection is not None else None
+    if started:
+        started.pop()
+    record_query_error()
+
+
+def track_queries(engine):
+    """
+    Times every statement run on engine for the metrics. Async engines are
+    instrumented through the sync engine they wrap.
+    """
+    engine = getattr(engine, "sync_engine", engine)
+    event.listen(engine, "before_cursor_execute", query_started)
+    event.listen(engine, "after_cursor_execute", query_finished)
+    event.listen(engine, "handle_error", query_failed)
+
+
+track_queries(engine)
+
+
+if DB_ASYNC:
+    async def get_db():
+        async with SessionLocal() as db:
+            yield db
+else:
+    def get_db():
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+@contextlib.asynccontextmanager
+async def open_session():
+    """
+    A session for work outside of a request, such as background jobs.
+    """
+    if DB_ASYNC:
+        async with SessionLocal() as db:
+            yield db
+    else:
+        db = SessionLocal()
+        try:
+            yield db
+        finally:
+            await run_in_threadpool(db.close)
+
+
+async def run_db(db, fn, *args, **kwargs):
+    """
+    Calls fn(session, *args, **kwargs) without blocking the event loop. Plain
+    sessions run on the threadpool, async ones hand fn a sync view of
+    themselves through run_sync.
+    """
+    if isinstance(db, AsyncSession):
+        return await db.run_sync(fn, *args, **kwargs)
+    return await run_in_threadpool(fn, db, *args, **kwargs)
+
+
+async def run_with_connection(fn):
+    """
+    Calls fn(connection) inside a transaction, for schema setup.
+    """
+    if DB_ASYNC:
+        async with engine.begin() as connection:
+            await connection.run_sync(fn)
+    else:
+        def run():
+            with engine.begin() as connection:
+                fn(connection)
+        await run_in_threadpool(run)
+
+
+async def warm_pool(connections: int):
+    """
+    Opens connections before the first requests arrive, so they do not pay
+    for connecting. Also fails early if the database is unreachable.
+    """
+    if DB_ASYNC:
+        held = []
+        try:
+            for _ in range(connections):
+                held.append(await engine.connect())
+                await held[-1].execute(text("select 1"))
+        finally:
+            for connection in held:
+                await connection.close()
+    else:
+        def warm():
+            held = []
+            try:
+                for _ in range(connections):
+                    held.append(engine.connect())
+                    held[-1].execute(text("select 1"))
+            finally:
+                for connection in held:
+                    connection.close()
+        await run_in_threadpool(warm)
@@ -1,5 +1,4 @@
-from sqlalchemy import Column, ForeignKey, Integer, String, true, Table
-from sqlalchemy_utils import CompositeType
+from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, Float, ForeignKey, Index, Integer, String, func, true, Table
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -7,7 +6,8 @@ from .database import Base
 
 association_table = Table('favs', Base.metadata,
     Column('user_id', ForeignKey('users.id'), primary_key=True),
-    Column('song_id', ForeignKey('songs.id'), primary_key=True)
+    Column('song_id', ForeignKey('songs.id'), primary_key=True),
+    Column('faved_at', DateTime, server_default=func.now())
     )
 
 class User(Base):
@@ -15,53 +15,110 @@ class User(Base):
     id = Column(Integer, primary_key=True, index=True, autoincrement=True)
     username = Column(String, unique=True)
     hashed_password = Column("pass", String)
-    songs_uploaded = relationship("Song", back_populates="user")
-    songs_faved = relationship("Song", secondary=association_table)
+    uploaded_count = Column(Integer, default=0, nullable=False)
+    faved_count = Column(Integer, default=0, nullable=False)
+    songs_uploaded = relationship("Song", back_populates="user", lazy="dynamic")
+    songs_faved = relationship("Song", secondary=association_table, lazy="dynamic")
 
 class Song(Base):
     __tablename__ = "songs"
     id = Column(Integer, primary_key=true, index=True, autoincrement=True)
     song_name = Column(String)
     author = Column(String)
-    easy_diff = Column(
-        CompositeType(
-            "song_diff",
-            [
-                Column("difficulty", String),
-                Column("chart", String),
-                Column("charter", String)
-            ]
-        )
-    )
-    normal_diff = Column(
-        CompositeType(
-            "song_diff",
-            [
-                Column("difficulty", String),
-                Column("chart", String),
-                Column("charter", String)
-            ]
-        )
-    )
-    hard_diff = Column(
-        CompositeType(
-            "song_diff",
-            [
-                Column("difficulty", String),
-                Column("chart", String),
-                Column("charter", String)
-            ]
-        )
-    )
-    song_art = Column(
-        CompositeType(
-            "albumart",
-            [
-                Column("image", String),
-                Column("artist", String)
-            ]
-        )
-    )
+    jacket = Column(String)
+    jacket_artist = Column(String)
     music = Column(String)
-    uploader = Column(Integer, ForeignKey("users.id"))
-    user = relationship("User", back_populates="songs_uploaded")
\ No newline at end of file
+    uploader = Column(Integer, ForeignKey("users.id"), index=True)
+    # compressed copies of music: pending, processing, ready or failed
+    audio_status = Column(String, default="pending", nullable=False, index=True)
+    user = relationship("User", back_populates="songs_uploaded")
+    # a page of songs loads all its charts with one extra IN query
+    charts = relationship("Chart", lazy="selectin", cascade="all, delete-orphan", passive_deletes=True)
+
+    def chart(self, level: str):
+        for chart in self.charts:
+            if chart.level == level:
+                return chart
+        return None
+
+    def _diff(self, level: str):
+        chart = self.chart(level)
+        if chart is None:
+            return (None, None, None)
+        return (chart.difficulty, chart.blob, chart.charter)
+
+    # (difficulty, chart, charter) and (image, artist) tuples, the shape the
+    # API had when these were composite columns
+    @property
+    def easy_diff(self):
+        return self._diff("easy")
+
+    @property
+    def normal_diff(self):
+        return self._diff("normal")
+
+    @property
+    def hard_diff(self):
+        return self._diff("hard")
+
+    @property
+    def song_art(self):
+        return (self.jacket, self.jacket_artist)
+
+class Chart(Base):
+    __tablename__ = "charts"
+    song_id = Column(Integer, ForeignKey("songs.id", ondelete="CASCADE"), primary_key=True)
+    level = Column(String, primary_key=True)
+    difficulty = Column(String)
+    # leading number of difficulty, so ranges can use an index
+    difficulty_value = Column(Float)
+    charter = Column(String)
+    blob = Column(String)
+
+Index("charts_charter_idx", func.lower(Chart.charter), Chart.level)
+Index("charts_difficulty_idx", Chart.level, Chart.difficulty_value)
+
+class AudioVariant(Base):
+    __tablename__ = "audio_variants"
+    song_id = Column(Integer, ForeignKey("songs.id", ondelete="CASCADE"), primary_key=True)
+    format = Column(String, primary_key=True)
+    blob = Column(String)
+
+class SongDownloads(Base):
+    """
+    Downloads of a song per day, written in batches by the download counter.
+    """
+    __tablename__ = "song_downloads"
+    song_id = Column(Integer, ForeignKey("songs.id", ondelete="CASCADE"), primary_key=True)
+    day = Column(Date, primary_key=True, index=True)
+    audio = Column(BigInteger, default=0, nullable=False)
+    charts = Column(BigInteger, default=0, nullable=False)
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    name = Column(String, primary_key=True)
+    kind = Column(String)
+    size = Column(BigInteger)
+    refcount = Column(Integer, default=0, index=True)
+    # uploads between storing the file and committing the song that references it
+    leases = Column(Integer, default=0, nullable=False)
+
+class StoreStats(Base):
+    __tablename__ = "store_stats"
+    id = Column(Integer, primary_key=True)
+    total_songs = Column(BigInteger, default=0, nullable=False)
+    # last version handed to catalogue_changes, bumping it serializes writers so versions commit in order
+    catalogue_version = Column(BigInteger, default=0, nullable=False)
+
+class CatalogueChange(Base):
+    """
+    Latest change of a song, one row per song and scope: the public catalogue
+    (user_id null) or what one user sees of it, such as their favs.
+    """
+    __tablename__ = "catalogue_changes"
+    version = Column(BigInteger, primary_key=True)
+    song_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=True)
+    deleted = Column(Boolean, default=False, nullable=False)
+
+Index("catalogue_changes_song_idx", CatalogueChange.song_id, CatalogueChange.user_id)
\ No newline at end of file
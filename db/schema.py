@@ -0,0 +1,64 @@
+from typing import List
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from . import crud, models, search
+
+
+class SchemaOutdated(Exception):
+
+    def __init__(self, missing: List[str]):
+        super().__init__(
+            f"database is missing {', '.join(missing)}, "
+            "run the scripts in db/sql/migrations it has not had yet (see README)"
+        )
+        self.missing = missing
+
+
+def missing_tables(connection: Connection) -> List[str]:
+    inspector = inspect(connection)
+    return [table.name for table in models.Base.metadata.sorted_tables if not inspector.has_table(table.name)]
+
+
+def missing_columns(connection: Connection) -> List[str]:
+    """
+    Columns the models have but existing tables lack, which is what an
+    unapplied migration looks like. Missing tables are not reported,
+    create_all adds those.
+    """
+    inspector = inspect(connection)
+    missing = []
+    for table in models.Base.metadata.sorted_tables:
+        if not inspector.has_table(table.name):
+            continue
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        missing.extend(f"{table.name}.{column.name}" for column in table.columns if column.name not in existing)
+    return missing
+
+
+def init_schema(connection: Connection):
+    """
+    Creates missing tables, the search index and the maintained counters.
+    Safe to run on every start, but meant to run once per deploy rather than
+    once per worker.
+    """
+    models.Base.metadata.create_all(bind=connection)
+    missing = missing_columns(connection)
+    if missing:
+        raise SchemaOutdated(missing)
+    search.create_search_index(connection)
+    with Session(bind=connection) as db:
+        crud.init_stats(db)
+
+
+def recover_interrupted(connection: Connection):
+    """
+    Undoes what workers that stopped half way through left behind. Only safe
+    while no worker runs, so it is never part of init_schema, python server.py
+    recover runs it on request.
+    """
+    with Session(bind=connection) as db:
+        crud.clear_blob_leases(db)
+        crud.requeue_interrupted_audio_jobs(db)
@@ -29,6 +29,18 @@ def as_form(cls: Type[BaseModel]):
     return cls
 
 
+class Difficulty(str, Enum):
+    EASY = "easy"
+    NORMAL = "normal"
+    HARD = "hard"
+
+
+class AudioFormat(str, Enum):
+    WAV = "wav"
+    OGG = "ogg"
+    MP3 = "mp3"
+
+
 class SongBase(BaseModel):
     song_name: str
     author: str
@@ -65,11 +77,19 @@ class SongCreateAPI(BaseModel):
 class Song(SongBase):
     id: int
     isFaved: bool = None
+    audio_status: Optional[str] = None
     
     class Config:
         orm_mode = True
         
 
+class CatalogueDelta(BaseModel):
+    version: int
+    songs: List[Song]
+    removed: List[int]
+    more: bool
+
+
 class UserBase(BaseModel):
     username: str
 
@@ -84,6 +104,8 @@ class UserUpdate(BaseModel):
 
 class User(UserBase):
     id: int
+    uploaded_count: int = 0
+    faved_count: int = 0
     # songs_uploaded: List[Song] = []
 
     class Config:
@@ -111,6 +133,7 @@ class Token(BaseModel):
 
 class TokenData(BaseModel):
     username: Optional[str] = None
+    user_id: Optional[int] = None
 
 class FavStatus(str, Enum):
     FAVED = "faved"
@@ -120,6 +143,21 @@ class FavStatus(str, Enum):
     class Config:
         orm_mode = True
 
+class FavChange(str, Enum):
+    FAVED = "faved"
+    UNFAVED = "unfaved"
+    ALREADY_FAVED = "already_faved"
+    NOT_FAVED = "not_faved"
+    NOT_FOUND = "not_found"
+
+class FavResult(BaseModel):
+    song_id: int
+    result: FavChange
+
+class FavsUpdate(BaseModel):
+    add: List[int] = []
+    remove: List[int] = []
+
 class SongStatus(BaseModel):
     song: Song
     status: FavStatus
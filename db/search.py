@@ -0,0 +1,98 @@
+import re
+
+from typing import List
+
+from sqlalchemy import Float, Integer, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from . import models
+
+# Songs are indexed in a side table keyed by song id. Postgres gets a tsvector
+# for ranked prefix matching plus a trigram index to tolerate typos, SQLite an
+# FTS5 table with prefix indexes.
+POSTGRES_DDL = [
+    "create extension if not exists pg_trgm",
+    """create table if not exists song_search
+    (
+        song_id  integer primary key references songs(id) on delete cascade,
+        document text not null,
+        vector   tsvector not null
+    )""",
+    "create index if not exists song_search_vector_idx on song_search using gin (vector)",
+    "create index if not exists song_search_trgm_idx on song_search using gin (document gin_trgm_ops)",
+]
+
+SQLITE_DDL = [
+    "create virtual table if not exists song_search using fts5(document, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')",
+]
+
+
+def _is_sqlite(bind) -> bool:
+    return bind.dialect.name == "sqlite"
+
+
+def search_document(song: models.Song) -> str:
+    parts = [
+        song.song_name,
+        song.author,
+        song.easy_diff[2],
+        song.normal_diff[2],
+        song.hard_diff[2],
+        song.song_art[1],
+    ]
+    return " ".join(part for part in parts if part)
+
+
+def search_terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def create_search_index(connection: Connection):
+    """
+    Creates the search table if needed and indexes every song missing from it.
+    """
+    for statement in SQLITE_DDL if _is_sqlite(connection) else POSTGRES_DDL:
+        connection.execute(text(statement))
+    with Session(bind=connection) as db:
+        key = "rowid" if _is_sqlite(connection) else "song_id"
+        unindexed = text(f"songs.id not in (select {key} from song_search)")
+        for song in db.query(models.Song).filter(unindexed):
+            index_song(db, song)
+        db.commit()
+
+
+def index_song(db: Session, song: models.Song):
+    document = search_document(song)
+    if _is_sqlite(db.get_bind()):
+        statement = "insert into song_search (rowid, document) values (:song_id, :document)"
+    else:
+        statement = (
+            "insert into song_search (song_id, document, vector) "
+            "values (:song_id, :document, to_tsvector('simple', :document))"
+        )
+    db.execute(text(statement), {"song_id": song.id, "document": document})
+
+
+def unindex_song(db: Session, song_id: int):
+    key = "rowid" if _is_sqlite(db.get_bind()) else "song_id"
+    db.execute(text(f"delete from song_search where {key} = :song_id"), {"song_id": song_id})
+
+
+def match_songs(db: Session, terms: List[str]):
+    """
+    Subquery of (song_id, rank) for songs matching every term as a prefix,
+    higher rank first.
+    """
+    if _is_sqlite(db.get_bind()):
+        statement = text(
+            "select rowid as song_id, -bm25(song_search) as rank "
+            "from song_search where song_search match :match"
+        ).bindparams(match=" ".join(f'"{term}"*' for term in terms))
+    else:
+        statement = text(
+            "select song_id, ts_rank(vector, query) + similarity(document, :plain) as rank "
+            "from song_search, to_tsquery('simple', :tsquery) as query "
+            "where vector @@ query or document % :plain"
+        ).bindparams(tsquery=" & ".join(f"{term}:*" for term in terms), plain=" ".join(terms))
+    return statement.columns(song_id=Integer, rank=Float).subquery("matches")
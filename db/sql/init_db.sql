@@ -1,42 +1,115 @@
 create table users
 (
-    id       serial primary key,
-    username text,
-    pass     text
+    id             serial primary key,
+    username       text,
+    pass           text,
+    uploaded_count integer not null default 0,
+    faved_count    integer not null default 0
 );
 
-create type song_diff as
-(
-    difficulty text,
-    chart text,
-    charter text
-);
+create unique index users_username_idx on users (username);
 
-create type albumart as
+create table songs
 (
-    image text,
-    artist text
+    id            serial primary key,
+    song_name     text,
+    author        text,
+    jacket        text,
+    jacket_artist text,
+    music         text,
+    uploader      integer,
+    audio_status  text not null default 'pending',
+    constraint    fk_user foreign key(uploader) references users(id)
 );
 
-create table songs
+create index songs_uploader_idx on songs (uploader);
+create index songs_audio_status_idx on songs (audio_status);
+
+create table charts
 (
-    id          serial primary key,
-    song_name    text,
-    author      text,
-    easy_diff   song_diff,
-    normal_diff song_diff,
-    hard_diff   song_diff,
-    song_art    albumart,
-    music   text,
-    uploader    integer,
-    constraint  fk_user foreign key(uploader) references users(id)
+    song_id          integer,
+    level            text,
+    difficulty       text,
+    difficulty_value real,
+    charter          text,
+    blob             text,
+    constraint pk_charts primary key (song_id, level),
+    constraint fk_song_chart foreign key(song_id) references songs(id) on delete cascade
 );
 
+create index charts_charter_idx on charts (lower(charter), level);
+create index charts_difficulty_idx on charts (level, difficulty_value);
+
 create table favs
 (
     user_id integer,
     song_id integer,
+    faved_at timestamp default now(),
     constraint pk_favs primary key (user_id, song_id),
     constraint fk_user_fav foreign key(user_id) references users(id) on delete cascade,
     constraint fk_song_fav foreign key(song_id) references songs(id) on delete cascade
-)
\ No newline at end of file
+);
+
+create table audio_variants
+(
+    song_id integer,
+    format  text,
+    blob    text,
+    constraint pk_audio_variants primary key (song_id, format),
+    constraint fk_song_audio_variant foreign key(song_id) references songs(id) on delete cascade
+);
+
+create table song_downloads
+(
+    song_id integer,
+    day     date,
+    audio   bigint not null default 0,
+    charts  bigint not null default 0,
+    constraint pk_song_downloads primary key (song_id, day),
+    constraint fk_song_downloads foreign key(song_id) references songs(id) on delete cascade
+);
+
+create index song_downloads_day_idx on song_downloads (day);
+
+create table blobs
+(
+    name     text primary key,
+    kind     text,
+    size     bigint,
+    refcount integer default 0,
+    leases   integer not null default 0
+);
+
+create index blobs_orphan_idx on blobs (refcount) where refcount <= 0;
+
+create extension if not exists pg_trgm;
+
+create table song_search
+(
+    song_id  integer primary key references songs(id) on delete cascade,
+    document text not null,
+    vector   tsvector not null
+);
+
+create index song_search_vector_idx on song_search using gin (vector);
+create index song_search_trgm_idx on song_search using gin (document gin_trgm_ops);
+
+create table store_stats
+(
+    id                integer primary key,
+    total_songs       bigint not null default 0,
+    catalogue_version bigint not null default 0
+);
+
+create table catalogue_changes
+(
+    version bigint,
+    song_id integer,
+    user_id integer,
+    deleted boolean not null default false,
+    constraint pk_catalogue_changes primary key (version, song_id)
+);
+
+create index catalogue_changes_song_idx on catalogue_changes (song_id, user_id);
+
+insert into store_stats (id, total_songs) values (1, 0);
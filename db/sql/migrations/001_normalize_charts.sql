@@ -0,0 +1,51 @@
+-- Moves the song_diff and albumart composite columns of songs into the charts
+-- table and plain jacket columns. Run once against databases created with the
+-- old init_db.sql.
+
+begin;
+
+alter table songs
+    add column jacket        text,
+    add column jacket_artist text;
+
+update songs set jacket = (song_art).image, jacket_artist = (song_art).artist;
+
+create table charts
+(
+    song_id          integer,
+    level            text,
+    difficulty       text,
+    difficulty_value real,
+    charter          text,
+    blob             text,
+    constraint pk_charts primary key (song_id, level),
+    constraint fk_song_chart foreign key(song_id) references songs(id) on delete cascade
+);
+
+-- Every song gets all three levels, as create_song writes them. A slot without
+-- a chart file keeps its difficulty and charter with a null blob. No filter on
+-- diff here: on a composite, "is not null" is only true when every field is set.
+insert into charts (song_id, level, difficulty, difficulty_value, charter, blob)
+select id, level, (diff).difficulty, substring((diff).difficulty from '^\s*([0-9]+(\.[0-9]+)?)')::real, (diff).charter, (diff).chart
+from (
+    select id, 'easy' as level, easy_diff as diff from songs
+    union all
+    select id, 'normal', normal_diff from songs
+    union all
+    select id, 'hard', hard_diff from songs
+) as diffs;
+
+create index charts_charter_idx on charts (lower(charter), level);
+create index charts_difficulty_idx on charts (level, difficulty_value);
+create index songs_uploader_idx on songs (uploader);
+
+alter table songs
+    drop column easy_diff,
+    drop column normal_diff,
+    drop column hard_diff,
+    drop column song_art;
+
+drop type song_diff;
+drop type albumart;
+
+commit;
@@ -0,0 +1,21 @@
+-- Adds the counters kept up to date by crud and fills them from the current data.
+
+begin;
+
+alter table users
+    add column uploaded_count integer not null default 0,
+    add column faved_count    integer not null default 0;
+
+update users set
+    uploaded_count = (select count(*) from songs where songs.uploader = users.id),
+    faved_count = (select count(*) from favs where favs.user_id = users.id);
+
+create table store_stats
+(
+    id          integer primary key,
+    total_songs bigint not null default 0
+);
+
+insert into store_stats (id, total_songs) select 1, count(*) from songs;
+
+commit;
@@ -0,0 +1,19 @@
+-- Adds the compressed audio variants produced in the background. Existing
+-- songs start out pending and get transcoded after the next start.
+
+begin;
+
+alter table songs add column audio_status text not null default 'pending';
+
+create index songs_audio_status_idx on songs (audio_status);
+
+create table audio_variants
+(
+    song_id integer,
+    format  text,
+    blob    text,
+    constraint pk_audio_variants primary key (song_id, format),
+    constraint fk_song_audio_variant foreign key(song_id) references songs(id) on delete cascade
+);
+
+commit;
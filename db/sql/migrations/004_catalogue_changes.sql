@@ -0,0 +1,24 @@
+-- Adds the change log behind /sync. Every existing song is logged once, each
+-- at its own version so a client syncing from 0 receives the whole catalogue
+-- in pages of SYNC_MAX_SONGS, a version is never split between two pages.
+
+begin;
+
+alter table store_stats add column catalogue_version bigint not null default 0;
+
+create table catalogue_changes
+(
+    version bigint,
+    song_id integer,
+    user_id integer,
+    deleted boolean not null default false,
+    constraint pk_catalogue_changes primary key (version, song_id)
+);
+
+create index catalogue_changes_song_idx on catalogue_changes (song_id, user_id);
+
+insert into catalogue_changes (version, song_id) select row_number() over (order by id), id from songs;
+
+update store_stats set catalogue_version = (select coalesce(max(version), 0) from catalogue_changes);
+
+commit;
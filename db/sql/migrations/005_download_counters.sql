@@ -0,0 +1,21 @@
+-- Adds per day download counters and the time a song was faved, both used to
+-- rank trending songs. Favs from before have no time and count as old.
+
+begin;
+
+alter table favs add column faved_at timestamp;
+alter table favs alter column faved_at set default now();
+
+create table song_downloads
+(
+    song_id integer,
+    day     date,
+    audio   bigint not null default 0,
+    charts  bigint not null default 0,
+    constraint pk_song_downloads primary key (song_id, day),
+    constraint fk_song_downloads foreign key(song_id) references songs(id) on delete cascade
+);
+
+create index song_downloads_day_idx on song_downloads (day);
+
+commit;
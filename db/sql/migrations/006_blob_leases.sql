@@ -0,0 +1,10 @@
+-- Adds the leases uploads hold on a blob between storing its file and
+-- committing the song that references it. Blobs with a lease are never
+-- collected. Databases that never started with the blob store have no
+-- blobs table yet, the next start creates it with the column.
+
+begin;
+
+alter table if exists blobs add column if not exists leases integer not null default 0;
+
+commit;
@@ -0,0 +1,75 @@
+import math
+
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from . import models
+
+
+def _weight(now: datetime, day: date, decay: float) -> float:
+    # a day's events are taken to have happened at its middle
+    age = (now - datetime.combine(day, datetime.min.time())).total_seconds() / 86400 - 0.5
+    return math.exp(-decay * max(age, 0))
+
+
+def trending_scores(
+    db: Session,
+    now: datetime,
+    window_days: int,
+    half_life_days: float,
+    chart_weight: float,
+    fav_weight: float,
+) -> Dict[int, float]:
+    """
+    Score of every song downloaded or faved within the window. Each download
+    and fav counts less the older it is, halving every half_life_days.
+    """
+    decay = math.log(2) / half_life_days
+    since = now - timedelta(days=window_days)
+    scores: Dict[int, float] = {}
+
+    downloads = db.query(
+        models.SongDownloads.song_id, models.SongDownloads.day, models.SongDownloads.audio, models.SongDownloads.charts
+    ).filter(models.SongDownloads.day >= since.date())
+    for song_id, day, audio, charts in downloads:
+        scores[song_id] = scores.get(song_id, 0) + (audio + chart_weight * charts) * _weight(now, day, decay)
+
+    favs = models.association_table
+    faved_at = func.date(favs.c.faved_at)
+    recent_favs = db.query(favs.c.song_id, faved_at, func.count()).filter(
+        favs.c.faved_at >= since
+    ).group_by(favs.c.song_id, faved_at)
+    for song_id, day, count in recent_favs:
+        # sqlite hands date() back as text
+        if isinstance(day, str):
+            day = date.fromisoformat(day)
+        scores[song_id] = scores.get(song_id, 0) + fav_weight * count * _weight(now, day, decay)
+    return scores
+
+
+class TrendingRanking:
+    """
+    The top songs by trending score, recomputed periodically and served from
+    memory in between.
+    """
+
+    def __init__(self, size: int, window_days: int, half_life_days: float, chart_weight: float, fav_weight: float):
+        self.size = size
+        self.window_days = window_days
+        self.half_life_days = half_life_days
+        self.chart_weight = chart_weight
+        self.fav_weight = fav_weight
+        self.ranking: List[Tuple[int, float]] = []
+        self.computed_at: Optional[datetime] = None
+
+    def refresh(self, db: Session, now: Optional[datetime] = None):
+        now = now or datetime.utcnow()
+        scores = trending_scores(db, now, self.window_days, self.half_life_days, self.chart_weight, self.fav_weight)
+        self.ranking = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:self.size]
+        self.computed_at = now
+
+    def top(self, skip: int = 0, limit: int = 100) -> List[int]:
+        return [song_id for song_id, _ in self.ranking[skip:skip + limit]]
@@ -0,0 +1,164 @@
+import hashlib
+import os
+import uuid
+
+from typing import Awaitable, Callable, NamedTuple, Optional, Tuple
+
+import aiofiles
+
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from metrics.registry import registry
+
+from . import uploads
+
+stored_bytes = registry.counter("storage_written_bytes_total", "Bytes of new blobs stored, by kind.", ["kind"])
+
+
+class StoredBlob(NamedTuple):
+    kind: str
+    name: str
+    size: int
+
+
+# called with a blob before its file is put in place, see crud.lease_blob
+Lease = Callable[[StoredBlob], Awaitable[None]]
+
+
+class BlobBackend:
+    """
+    Where blob bytes live. Blobs are addressed by kind ("audio", "images",
+    "charts") and name, which is the sha256 of the content plus an extension.
+    Implementations must be safe to call from several threads.
+    """
+
+    def temp_path(self) -> str:
+        """Local path where a new blob can be staged before put()."""
+        raise NotImplementedError
+
+    def put(self, kind: str, name: str, temp_path: str):
+        """Takes ownership of temp_path and stores it as kind/name."""
+        raise NotImplementedError
+
+    def exists(self, kind: str, name: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, kind: str, name: str):
+        raise NotImplementedError
+
+    def local_path(self, kind: str, name: str) -> str:
+        """Filesystem path the blob can be served from."""
+        raise NotImplementedError
+
+
+class LocalBlobBackend(BlobBackend):
+
+    def __init__(self, root: str):
+        self.root = root
+        self.temp_dir = os.path.join(root, "tmp")
+
+    def temp_path(self) -> str:
+        os.makedirs(self.temp_dir, exist_ok=True)
+        return os.path.join(self.temp_dir, f"{uuid.uuid4().hex}.part")
+
+    def put(self, kind: str, name: str, temp_path: str):
+        path = self.local_path(kind, name)
+        if os.path.exists(path):
+            # identical content, keep the existing file and its Last-Modified
+            os.remove(temp_path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def exists(self, kind: str, name: str) -> bool:
+        return os.path.exists(self.local_path(kind, name))
+
+    def delete(self, kind: str, name: str):
+        try:
+            os.remove(self.local_path(kind, name))
+        except FileNotFoundError:
+            pass
+
+    def local_path(self, kind: str, name: str) -> str:
+        return os.path.join(self.root, kind, name)
+
+
+def _hash_file(path: str) -> Tuple[int, str]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(uploads.CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class BlobStore:
+    """
+    The save methods call lease, when given, once the name of the blob is
+    known and before its file is put in place. A lease left behind by a
+    failing put() is cleared by python server.py recover.
+    """
+
+    def __init__(self, backend: BlobBackend):
+        self.backend = backend
+
+    async def _put(self, blob: StoredBlob, temp_path: str, lease: Optional[Lease]):
+        if lease is not None:
+            await lease(blob)
+        await run_in_threadpool(self.backend.put, blob.kind, blob.name, temp_path)
+
+    async def save_upload(
+        self, upload: UploadFile, field: str, kind: str, suffix: str, max_bytes: int, lease: Optional[Lease] = None
+    ) -> StoredBlob:
+        temp_path = self.backend.temp_path()
+        size, digest = await uploads.stream_upload(upload, field, temp_path, max_bytes)
+        blob = StoredBlob(kind, f"{digest}{suffix}", size)
+        try:
+            await self._put(blob, temp_path, lease)
+        except BaseException:
+            await uploads.remove_files([temp_path])
+            raise
+        stored_bytes.inc(size, (kind,))
+        return blob
+
+    async def save_file(self, temp_path: str, kind: str, suffix: str, lease: Optional[Lease] = None) -> StoredBlob:
+        """
+        Stores a file produced on the server, staged at a temp_path() of the
+        backend, under the sha256 of its content.
+        """
+        try:
+            size, digest = await run_in_threadpool(_hash_file, temp_path)
+            blob = StoredBlob(kind, f"{digest}{suffix}", size)
+            await self._put(blob, temp_path, lease)
+        except BaseException:
+            await uploads.remove_files([temp_path])
+            raise
+        stored_bytes.inc(blob.size, (kind,))
+        return blob
+
+    async def save_bytes(self, data: bytes, kind: str, name: str, lease: Optional[Lease] = None) -> StoredBlob:
+        temp_path = self.backend.temp_path()
+        blob = StoredBlob(kind, name, len(data))
+        try:
+            async with aiofiles.open(temp_path, "wb") as f:
+                await f.write(data)
+            await self._put(blob, temp_path, lease)
+        except BaseException:
+            await uploads.remove_files([temp_path])
+            raise
+        stored_bytes.inc(len(data), (kind,))
+        return blob
+
+    def temp_path(self) -> str:
+        return self.backend.temp_path()
+
+    def local_path(self, kind: str, name: str) -> str:
+        return self.backend.local_path(kind, name)
+
+    def delete(self, kind: str, name: str):
+        self.backend.delete(kind, name)
+
+
+blob_store = BlobStore(LocalBlobBackend(os.environ.get("STORAGE_DIR", "./storage")))
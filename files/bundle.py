@@ -0,0 +1,116 @@
+import os
+import tarfile
+import time
+
+from typing import Iterable, List, NamedTuple, Optional
+from xml.etree import ElementTree as ET
+
+import aiofiles
+
+from fastapi.responses import StreamingResponse
+
+from db import models
+from . import charts
+from .blobs import blob_store
+from .uploads import CHUNK_SIZE
+
+BLOCK_SIZE = tarfile.BLOCKSIZE
+
+
+class BundleEntry(NamedTuple):
+    header: bytes
+    size: int
+    path: Optional[str] = None
+    data: Optional[bytes] = None
+    # gzip stored charts go into the tar decompressed
+    compressed: bool = False
+
+
+def song_info_xml(song: models.Song) -> bytes:
+    """
+    Rebuilds the song info XML in the same shape POST /songs/ accepts.
+    """
+    root = ET.Element("song")
+    ET.SubElement(root, "title").text = song.song_name
+    ET.SubElement(root, "artist").text = song.author
+    for difficulty in ("easy", "normal", "hard"):
+        diff = getattr(song, f"{difficulty}_diff")
+        ET.SubElement(root, difficulty, difficulty=diff[0] or "", charter=diff[2] or "")
+    ET.SubElement(root, "jacket", artist=song.song_art[1] or "")
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+
+def _header(name: str, size: int, mtime: float) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _padding(size: int) -> bytes:
+    return b"\0" * (-size % BLOCK_SIZE)
+
+
+def song_entries(song: models.Song, prefix: str = "") -> List[BundleEntry]:
+    xml = song_info_xml(song)
+    entries = [BundleEntry(_header(f"{prefix}song.xml", len(xml), time.time()), len(xml), data=xml)]
+    files = [
+        ("audio.wav", "audio", song.music),
+        ("jacket.png", "images", song.song_art[0]),
+        ("easy.chart", "charts", song.easy_diff[1]),
+        ("normal.chart", "charts", song.normal_diff[1]),
+        ("hard.chart", "charts", song.hard_diff[1]),
+    ]
+    for arcname, kind, name in files:
+        if name is None:
+            continue
+        path = blob_store.local_path(kind, name)
+        try:
+            stat = os.stat(path)
+            compressed = kind == "charts" and charts.is_compressed(path)
+            size = charts.chart_size(path) if compressed else stat.st_size
+        except FileNotFoundError:
+            continue
+        entries.append(BundleEntry(_header(f"{prefix}{arcname}", size, stat.st_mtime), size, path=path, compressed=compressed))
+    return entries
+
+
+async def _stream(entries: List[BundleEntry]):
+    for entry in entries:
+        yield entry.header
+        if entry.data is not None:
+            yield entry.data
+        elif entry.compressed:
+            decompressor = charts.decompressor()
+            async with aiofiles.open(entry.path, "rb") as f:
+                while chunk := await f.read(CHUNK_SIZE):
+                    yield decompressor.decompress(chunk)
+            yield decompressor.flush()
+        else:
+            async with aiofiles.open(entry.path, "rb") as f:
+                while chunk := await f.read(CHUNK_SIZE):
+                    yield chunk
+        yield _padding(entry.size)
+    # end of archive marker
+    yield b"\0" * (2 * BLOCK_SIZE)
+
+
+def bundle_response(songs: Iterable[models.Song], filename: str, prefix_ids: bool = False) -> StreamingResponse:
+    """
+    Streams the assets of songs as an uncompressed tar. Every entry is already
+    known up front so the exact Content-Length can be sent, while file contents
+    are read chunk by chunk and never held in memory.
+    """
+    entries = []
+    for song in songs:
+        entries.extend(song_entries(song, f"{song.id}/" if prefix_ids else ""))
+    length = sum(len(entry.header) + entry.size + len(_padding(entry.size)) for entry in entries) + 2 * BLOCK_SIZE
+    return StreamingResponse(
+        _stream(entries),
+        media_type="application/x-tar",
+        headers={
+            "Content-Length": str(length),
+            "Content-Disposition": f'attachment; filename="{filename}"',
+        },
+    )
@@ -0,0 +1,136 @@
+import gzip
+import hashlib
+import os
+import struct
+import zlib
+
+from typing import Optional
+
+from fastapi import Request, Response, UploadFile
+
+from . import serve, uploads
+from .blobs import Lease, StoredBlob, blob_store
+
+# Charts are stored gzip compressed. Files from before that are plain text and
+# are told apart by the gzip magic, which no text chart can start with.
+GZIP_MAGIC = b"\x1f\x8b"
+# what plain .chart files have always been served as
+CHART_MEDIA_TYPE = "application/octet-stream"
+# control characters other than tab and line breaks mean the upload is not a text chart
+FORBIDDEN_BYTES = bytes(set(range(32)) - {9, 10, 13})
+
+
+class InvalidChart(Exception):
+
+    def __init__(self, field: str, reason: str):
+        super().__init__(f"{field}: {reason}")
+        self.field = field
+        self.reason = reason
+
+
+def validate_chart(field: str, data: bytes):
+    """
+    Charts are line based UTF-8 text. The server does not interpret them any
+    further, but refuses empty files and anything binary.
+    """
+    if not data.strip():
+        raise InvalidChart(field, "chart is empty")
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise InvalidChart(field, "chart is not UTF-8 text")
+    if data.translate(None, FORBIDDEN_BYTES) != data:
+        raise InvalidChart(field, "chart contains binary data")
+
+
+async def save_chart(upload: UploadFile, field: str, max_bytes: int, lease: Optional[Lease] = None) -> StoredBlob:
+    """
+    Validates an uploaded chart, plain or gzip compressed, and stores it
+    compressed. The blob is named after the uncompressed content, so ETags
+    and deduplication follow what clients see.
+    """
+    data = await uploads.read_upload(upload, field, max_bytes)
+    if data.startswith(GZIP_MAGIC):
+        data = decompress_upload(field, data, max_bytes)
+    validate_chart(field, data)
+    # mtime=0 keeps the compressed bytes a pure function of the chart
+    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+    return await blob_store.save_bytes(compressed, "charts", f"{hashlib.sha256(data).hexdigest()}.chart", lease)
+
+
+def decompress_upload(field: str, data: bytes, max_bytes: int) -> bytes:
+    """
+    Unpacks a chart uploaded gzip compressed, holding it to the same limit
+    as a plain one however well it compresses.
+    """
+    unpacker = decompressor()
+    try:
+        # one byte past the limit tells a chart at the limit from a larger one
+        chart = unpacker.decompress(data, max_bytes + 1)
+    except zlib.error:
+        raise InvalidChart(field, "chart is not valid gzip")
+    if len(chart) > max_bytes:
+        raise uploads.UploadTooLarge(field, max_bytes)
+    if not unpacker.eof or unpacker.unused_data:
+        raise InvalidChart(field, "chart is not valid gzip")
+    return chart
+
+
+def is_compressed(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(2) == GZIP_MAGIC
+
+
+def chart_size(path: str) -> int:
+    """
+    Uncompressed size of a stored chart, read from the gzip trailer.
+    """
+    with open(path, "rb") as f:
+        if f.read(2) != GZIP_MAGIC:
+            return os.fstat(f.fileno()).st_size
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack("<I", f.read(4))[0]
+
+
+def decompressor():
+    # wbits 31 reads the gzip container
+    return zlib.decompressobj(31)
+
+
+def _accepts_gzip(request: Request) -> bool:
+    for part in request.headers.get("accept-encoding", "").split(","):
+        coding, *params = [piece.strip() for piece in part.split(";")]
+        if coding.lower() not in ("gzip", "x-gzip", "*"):
+            continue
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def chart_response(request: Request, path: str) -> Response:
+    """
+    Sends compressed charts as they are stored to clients that accept gzip,
+    and decompresses them for everyone else.
+    """
+    try:
+        compressed = is_compressed(path)
+    except FileNotFoundError:
+        return serve.asset_response(request, path)
+    if not compressed:
+        return serve.asset_response(request, path)
+    headers = {"Vary": "Accept-Encoding"}
+    if _accepts_gzip(request):
+        headers["Content-Encoding"] = "gzip"
+        return serve.asset_response(
+            request, path, media_type=CHART_MEDIA_TYPE, etag=serve.asset_etag(path, "gzip"), headers=headers
+        )
+    with open(path, "rb") as f:
+        content = gzip.decompress(f.read())
+    return serve.content_response(request, content, path, media_type=CHART_MEDIA_TYPE, headers=headers)
+
@@ -0,0 +1,153 @@
+import mimetypes
+import os
+
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+
+import aiofiles
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from .uploads import CHUNK_SIZE
+
+# Assets never change once uploaded, a song gets new blobs instead
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+# for a stand-in served at a URL that will later serve another blob, such as
+# the wav while the asked for audio variant is still being transcoded
+REVALIDATE = "no-cache"
+
+
+def asset_etag(path: str, encoding: Optional[str] = None) -> str:
+    # blob names are the content digest (or a uuid for old uploads)
+    tag = os.path.splitext(os.path.basename(path))[0]
+    if encoding is not None:
+        # every content coding of a file is a representation of its own
+        tag = f"{tag}-{encoding}"
+    return f'"{tag}"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    candidates = [candidate.strip() for candidate in header.split(",")]
+    return "*" in candidates or etag in [candidate[2:] if candidate.startswith("W/") else candidate for candidate in candidates]
+
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+def _parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Returns the inclusive byte span of a single "bytes=" range, None when the
+    header should be ignored and the whole file sent. Raises 416 when the range
+    cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return None
+    start, _, end = spec.strip().partition("-")
+    try:
+        if start == "":
+            length = int(end)
+            if length == 0:
+                raise ValueError(end)
+            first, last = max(size - length, 0), size - 1
+        else:
+            first = int(start)
+            last = min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if first >= size or first > last:
+        raise HTTPException(
+            status_code=416,
+            detail="Requested range not satisfiable",
+            headers={"Content-Range": f"bytes */{size}"},
+        )
+    return first, last
+
+
+async def _read_span(path: str, first: int, last: int):
+    remaining = last - first + 1
+    async with aiofiles.open(path, "rb") as f:
+        await f.seek(first)
+        while remaining > 0:
+            chunk = await f.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def _stat(path: str) -> os.stat_result:
+    try:
+        return os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="File not found")
+
+
+def _validators(stat: os.stat_result, etag: str, extra: Optional[dict], cache_control: str = CACHE_CONTROL) -> dict:
+    return {
+        **(extra or {}),
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+    }
+
+
+def asset_response(
+    request: Request,
+    path: str,
+    media_type: Optional[str] = None,
+    etag: Optional[str] = None,
+    headers: Optional[dict] = None,
+    cache_control: str = CACHE_CONTROL,
+) -> Response:
+    """
+    Serves an immutable asset with validators, conditional GET and single
+    byte ranges.
+    """
+    stat = _stat(path)
+    etag = etag or asset_etag(path)
+    headers = _validators(stat, etag, headers, cache_control)
+    headers["Accept-Ranges"] = "bytes"
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    if _not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header is not None and (if_range is None or if_range.strip() in (etag, headers["Last-Modified"])):
+        span = _parse_range(range_header, stat.st_size)
+        if span is not None:
+            first, last = span
+            headers["Content-Range"] = f"bytes {first}-{last}/{stat.st_size}"
+            headers["Content-Length"] = str(last - first + 1)
+            return StreamingResponse(
+                _read_span(path, first, last),
+                status_code=206,
+                headers=headers,
+                media_type=media_type,
+            )
+    return FileResponse(path, headers=headers, media_type=media_type)
+
+
+def content_response(request: Request, content: bytes, path: str, media_type: str, headers: Optional[dict] = None) -> Response:
+    """
+    Serves content derived in memory from the asset at path, with the
+    validators of that asset but without byte ranges.
+    """
+    stat = _stat(path)
+    etag = asset_etag(path)
+    headers = _validators(stat, etag, headers)
+    if _not_modified(request, etag, stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    return Response(content, headers=headers, media_type=media_type)
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+from PIL import Image, UnidentifiedImageError
+
+# Pillow format -> (extension, save options)
+THUMBNAIL_FORMATS = {
+    "JPEG": (".jpg", {"quality": 85, "optimize": True, "progressive": True}),
+    "WEBP": (".webp", {"quality": 80, "method": 4}),
+    "PNG": (".png", {"optimize": True}),
+}
+
+
+class ThumbnailError(Exception):
+    pass
+
+
+class ThumbnailCache:
+    """
+    Resized jackets on local disk, named after the source blob and the size so
+    they never go stale. Each size of each jacket is rendered once: concurrent
+    first requests in a worker share one render, and renders run on a small
+    dedicated pool so a cold grid page cannot take every CPU.
+
+    The directory is kept under max_bytes by evicting the least recently
+    served files. Hits bump the file's atime (throttled), which every worker
+    sharing the directory sees, so eviction order holds across processes.
+    """
+
+    # a hit refreshes the access stamp at most this often
+    TOUCH_INTERVAL = 3600
+
+    def __init__(self, root: str, sizes: Iterable[int], image_format: str, max_bytes: int, workers: int):
+        self.root = root
+        self.sizes = sorted(sizes)
+        self.format = image_format.upper()
+        self.suffix, self.save_options = THUMBNAIL_FORMATS[self.format]
+        self.max_bytes = max_bytes
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="thumbnail")
+        self._renders: Dict[str, asyncio.Future] = {}
+        self._evict_lock = threading.Lock()
+        # estimate of the directory size, recounted on the first render and on every eviction
+        self._used: Optional[int] = None
+
+    def path(self, blob_name: str, size: int) -> str:
+        stem = os.path.splitext(blob_name)[0]
+        return os.path.join(self.root, str(size), f"{stem}-{size}{self.suffix}")
+
+    async def get(self, source: str, blob_name: str, size: int) -> str:
+        """
+        Path of the size thumbnail of the image at source, rendering it first
+        if needed.
+        """
+        path = self.path(blob_name, size)
+        try:
+            self._touch(path)
+            return path
+        except FileNotFoundError:
+            pass
+        render = self._renders.get(path)
+        if render is None:
+            loop = asyncio.get_running_loop()
+            render = loop.run_in_executor(self._executor, self._render, source, path, size)
+            self._renders[path] = render
+            render.add_done_callback(lambda _: self._renders.pop(path, None))
+        # shield so a client going away does not cancel the render others wait on
+        await asyncio.shield(render)
+        return path
+
+    def _touch(self, path: str):
+        stat = os.stat(path)
+        now = time.time()
+        if now - stat.st_atime > self.TOUCH_INTERVAL:
+            os.utime(path, (now, stat.st_mtime))
+
+    def _render(self, source: str, path: str, size: int):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # unique across the processes sharing the directory, not just threads
+        temp_path = f"{path}.{uuid.uuid4().hex}.part"
+        try:
+            with Image.open(source) as image:
+                # lets JPEG sources decode at a fraction of their size
+                image.draft("RGB", (size, size))
+                image.thumbnail((size, size), Image.LANCZOS)
+                if self.format == "JPEG" and image.mode not in ("RGB", "L"):
+                    image = image.convert("RGB")
+                image.save(temp_path, self.format, **self.save_options)
+            os.replace(temp_path, path)
+        except BaseException as e:
+            try:
+                os.remove(temp_path)
+            except FileNotFoundError:
+                pass
+            if isinstance(e, UnidentifiedImageError):
+                raise ThumbnailError(f"{source} is not an image Pillow can read")
+            raise
+        self._account(os.path.getsize(path))
+
+    def _account(self, size: int):
+        with self._evict_lock:
+            if self._used is None:
+                self._used = self._scan_size()
+            else:
+                self._used += size
+            if self._used > self.max_bytes:
+                self._used = self._evict()
+
+    def _files(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if name.endswith(".part"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    pass
+
+    def _scan_size(self) -> int:
+        return sum(stat.st_size for _, stat in self._files())
+
+    def _evict(self) -> int:
+        """
+        Deletes least recently served thumbnails until the cache is at 90% of
+        its budget and returns the bytes left.
+        """
+        files = sorted(self._files(), key=lambda entry: entry[1].st_atime)
+        used = sum(stat.st_size for _, stat in files)
+        target = self.max_bytes * 0.9
+        for path, stat in files:
+            if used <= target:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            used -= stat.st_size
+        return used
+
+
+thumbnail_cache = ThumbnailCache(
+    root=os.environ.get("THUMBNAIL_DIR", os.path.join(os.environ.get("STORAGE_DIR", "./storage"), "thumbnails")),
+    sizes=[int(size) for size in os.environ.get("THUMBNAIL_SIZES", "64,128,256,512").split(",")],
+    image_format=os.environ.get("THUMBNAIL_FORMAT", "jpeg"),
+    max_bytes=int(os.environ.get("THUMBNAIL_CACHE_MB", 512)) * 1024 * 1024,
+    workers=int(os.environ.get("THUMBNAIL_WORKERS", 2)),
+)
@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import shutil
+
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+from .blobs import Lease, StoredBlob, blob_store
+from . import uploads
+
+logger = logging.getLogger(__name__)
+
+# format -> (content types clients ask for it with, extension, ffmpeg output options)
+AUDIO_FORMATS = {
+    "ogg": (("audio/ogg", "audio/opus"), ".ogg", ["-c:a", "libopus", "-b:a", "128k", "-f", "ogg"]),
+    "mp3": (("audio/mpeg", "audio/mp3"), ".mp3", ["-c:a", "libmp3lame", "-q:a", "2", "-f", "mp3"]),
+}
+WAV_CONTENT_TYPES = ("audio/wav", "audio/x-wav", "audio/wave")
+
+FFMPEG = os.environ.get("FFMPEG_PATH", "ffmpeg")
+TRANSCODE_TIMEOUT = float(os.environ.get("TRANSCODE_TIMEOUT_SECONDS", 600))
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def negotiate(requested: Optional[str], accept: Optional[str]) -> List[str]:
+    """
+    Audio formats in order of preference. An explicit format wins, then the
+    audio types named in Accept by quality. Wildcards do not count, so clients
+    that never asked for anything else keep getting the wav.
+    """
+    if requested is not None:
+        return [requested]
+    ranked = []
+    for position, part in enumerate((accept or "").split(",")):
+        media_type, *params = [piece.strip() for piece in part.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        audio_format = content_type_format(media_type.lower())
+        if audio_format is not None and quality > 0:
+            ranked.append((-quality, position, audio_format))
+    return [audio_format for _, _, audio_format in sorted(ranked)]
+
+
+def content_type_format(media_type: str) -> Optional[str]:
+    if media_type in WAV_CONTENT_TYPES:
+        return "wav"
+    for audio_format, (content_types, _, _) in AUDIO_FORMATS.items():
+        if media_type in content_types:
+            return audio_format
+    return None
+
+
+async def encode_audio(source: str, audio_format: str, lease: Optional[Lease] = None) -> StoredBlob:
+    """
+    Encodes the wav at source with ffmpeg and stores the result as an audio blob.
+    """
+    _, suffix, options = AUDIO_FORMATS[audio_format]
+    temp_path = blob_store.temp_path()
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG, "-nostdin", "-y", "-loglevel", "error", "-i", source, "-vn", *options, temp_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        _, stderr = await asyncio.wait_for(process.communicate(), TRANSCODE_TIMEOUT)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        await uploads.remove_files([temp_path])
+        raise
+    if process.returncode != 0:
+        await uploads.remove_files([temp_path])
+        raise TranscodeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    return await blob_store.save_file(temp_path, "audio", suffix, lease)
+
+
+class TranscodeQueue:
+    """
+    In-process job queue. Workers are asyncio tasks, the encoding itself runs
+    in ffmpeg subprocesses, so up to `workers` songs are transcoded at once
+    without blocking the event loop.
+    """
+
+    def __init__(self, job: Callable[[int], Awaitable[None]], formats: Iterable[str], workers: int):
+        self.job = job
+        self.formats = [audio_format for audio_format in formats if audio_format in AUDIO_FORMATS]
+        self.workers = workers
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.formats) and self.workers > 0 and shutil.which(FFMPEG) is not None
+
+    def start(self):
+        if not self.enabled:
+            logger.warning("audio transcoding disabled, no formats configured or %s not found", FFMPEG)
+            return
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._queue = None
+
+    def submit(self, song_id: int):
+        # songs submitted while disabled stay pending and are picked up on a later start
+        if self._queue is not None:
+            self._queue.put_nowait(song_id)
+
+    def pending(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def join(self):
+        if self._queue is not None:
+            await self._queue.join()
+
+    async def _work(self):
+        while True:
+            song_id = await self._queue.get()
+            try:
+                await self.job(song_id)
+            except Exception:
+                logger.exception("transcoding song %s failed", song_id)
+            finally:
+                self._queue.task_done()
+
@@ -0,0 +1,81 @@
+import hashlib
+
+from typing import Iterable, Tuple
+
+import aiofiles
+import aiofiles.os
+
+from fastapi import UploadFile
+from fastapi.responses import JSONResponse
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(Exception):
+    def __init__(self, field: str, max_bytes: int):
+        super().__init__(f"{field} is larger than {max_bytes} bytes")
+        self.field = field
+        self.max_bytes = max_bytes
+
+
+async def stream_upload(upload: UploadFile, field: str, path: str, max_bytes: int) -> Tuple[int, str]:
+    """
+    Streams an upload to path in CHUNK_SIZE pieces, hashing it on the way.
+    Returns the size and sha256 hex digest of the content. The partial file is
+    removed if the upload fails or goes over max_bytes.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        async with aiofiles.open(path, "wb") as f:
+            while chunk := await upload.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > max_bytes:
+                    raise UploadTooLarge(field, max_bytes)
+                digest.update(chunk)
+                await f.write(chunk)
+    except BaseException:
+        await remove_files([path])
+        raise
+    finally:
+        await upload.close()
+    return size, digest.hexdigest()
+
+
+async def read_upload(upload: UploadFile, field: str, max_bytes: int) -> bytes:
+    try:
+        data = await upload.read(max_bytes + 1)
+    finally:
+        await upload.close()
+    if len(data) > max_bytes:
+        raise UploadTooLarge(field, max_bytes)
+    return data
+
+
+async def remove_files(paths: Iterable[str]):
+    for path in paths:
+        try:
+            await aiofiles.os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class ContentLengthLimitMiddleware:
+    """
+    Rejects uploads whose declared Content-Length is already over the limit
+    before the multipart body is parsed and spooled to disk.
+    """
+
+    def __init__(self, app, max_bytes: int, paths: Iterable[str]):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = set(paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in self.paths:
+            length = dict(scope["headers"]).get(b"content-length")
+            if length is not None and length.isdigit() and int(length) > self.max_bytes:
+                response = JSONResponse({"detail": "Upload too large"}, status_code=413)
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
@@ -1,38 +1,85 @@
+import time
+
+# worker startup is timed from here, before the heavy imports
+IMPORT_STARTED = time.perf_counter()
+
+import asyncio
+import functools
+import logging
 import os
+import secrets
 
 from datetime import datetime, timedelta
 
 from typing import List, Optional
 
-from fastapi import Depends, FastAPI, HTTPException, UploadFile, status
-from fastapi.responses import FileResponse, RedirectResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, UploadFile, status
+from fastapi.responses import RedirectResponse
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 
-from db import crud, models, schemas
-from db.database import SessionLocal, engine
-from response import responses
+from settings import get_settings
+from db import crud, models, schemas, trending
+from db.database import DB_POOL_WARM, engine, get_db, open_session, run_db, run_with_connection, warm_pool
+from db.schema import init_schema
+from response import pagination, responses
+from response.fastjson import FastJSONResponse
+from cache.downloads import download_counter
+from cache.responses import response_cache
+from cache.users import user_cache
+from files import bundle, serve, transcode, uploads
+from files import charts as chart_files
+from files.blobs import StoredBlob, blob_store
+from files.thumbnails import ThumbnailError, thumbnail_cache
+from metrics.middleware import MetricsMiddleware
+from metrics.registry import registry
 
 import response.responses
 
-from passlib.context import CryptContext
+from security.hashing import HasherBusy, PasswordHasher
 from jose import JWTError, jwt
 
-import uuid
-
-from dotenv import load_dotenv
+from sqlalchemy import text
 
 from xml.etree import ElementTree as ET
 
-load_dotenv()
+logger = logging.getLogger(__name__)
 
-SECRET_KEY = os.environ.get("SECRET_KEY")
-ALGORITHM = os.environ.get("ALGORITHM")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.environ.get("ACCESS_TOKEN_EXPIRE_MINUTES"))
+hasher = PasswordHasher(
+    max_workers=int(os.environ.get("PASSWORD_HASH_WORKERS", 2)),
+    max_queue=int(os.environ.get("PASSWORD_HASH_MAX_QUEUE", 64)),
+)
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+MB = 1024 * 1024
+UPLOAD_LIMITS = {
+    "song_info": int(os.environ.get("MAX_SONG_INFO_UPLOAD_MB", 1)) * MB,
+    "audio": int(os.environ.get("MAX_AUDIO_UPLOAD_MB", 512)) * MB,
+    "art": int(os.environ.get("MAX_ART_UPLOAD_MB", 16)) * MB,
+    "chart": int(os.environ.get("MAX_CHART_UPLOAD_MB", 4)) * MB,
+}
+
+BUNDLE_MAX_SONGS = int(os.environ.get("BUNDLE_MAX_SONGS", 100))
+SYNC_MAX_SONGS = int(os.environ.get("SYNC_MAX_SONGS", 1000))
+FAVS_BATCH_MAX = int(os.environ.get("FAVS_BATCH_MAX", 1000))
+
+DOWNLOAD_FLUSH_SECONDS = float(os.environ.get("DOWNLOAD_FLUSH_SECONDS", 10))
+TRENDING_REFRESH_SECONDS = float(os.environ.get("TRENDING_REFRESH_SECONDS", 300))
+trending_ranking = trending.TrendingRanking(
+    size=int(os.environ.get("TRENDING_SIZE", 100)),
+    window_days=int(os.environ.get("TRENDING_WINDOW_DAYS", 14)),
+    half_life_days=float(os.environ.get("TRENDING_HALF_LIFE_DAYS", 3)),
+    chart_weight=float(os.environ.get("TRENDING_CHART_WEIGHT", 0.5)),
+    fav_weight=float(os.environ.get("TRENDING_FAV_WEIGHT", 5)),
+)
+background_tasks: List[asyncio.Task] = []
 
-models.Base.metadata.create_all(bind=engine)
+# Requests slower than this are logged with their SQL statements (optional)
+SLOW_REQUEST_MS = os.environ.get("SLOW_REQUEST_MS")
+# Bearer token GET /metrics requires, open to anyone if unset
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+# Longest /health/ready waits for the database
+READINESS_TIMEOUT = float(os.environ.get("READINESS_TIMEOUT_SECONDS", 2))
 
 tags_metadata = [
     {
@@ -53,37 +100,120 @@ tags_metadata = [
     },
 ]
 
+# title and description are filled in from the settings at startup, importing
+# this module needs no configuration
 app = FastAPI(
-    title="API for "+os.environ.get("STORE_NAME"),
-    description=os.environ.get("STORE_DESCRIPTION"),
+    title="API",
     openapi_tags=tags_metadata,
 )
+app.state.ready = False
+
+# Every file part at its limit, plus some room for the multipart framing
+app.add_middleware(
+    uploads.ContentLengthLimitMiddleware,
+    max_bytes=sum(UPLOAD_LIMITS.values()) + 2 * UPLOAD_LIMITS["chart"] + MB,
+    paths=["/songs/"],
+)
+# added last so it is outermost and also sees requests the limit above turns away
+app.add_middleware(
+    MetricsMiddleware,
+    router=app.router,
+    slow_seconds=float(SLOW_REQUEST_MS) / 1000 if SLOW_REQUEST_MS else None,
+)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 
-# Dependencies
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+startup_seconds = registry.gauge("startup_seconds", "How long this worker took to start, by phase.", ["phase"])
+
+@app.on_event("startup")
+async def startup():
+    started = time.perf_counter()
+    settings = get_settings()
+    app.title = f"API for {settings.store_name}"
+    app.description = settings.store_description
+    # python server.py has already done this once for all workers
+    if settings.init_schema:
+        await run_with_connection(init_schema)
+    await warm_pool(DB_POOL_WARM)
+    transcoder.start()
+    async with open_session() as db:
+        for song_id in await run_db(db, crud.get_songs_awaiting_audio):
+            transcoder.submit(song_id)
+    await warm_caches()
+    background_tasks.append(asyncio.create_task(repeat(DOWNLOAD_FLUSH_SECONDS, flush_downloads)))
+    background_tasks.append(asyncio.create_task(repeat(TRENDING_REFRESH_SECONDS, refresh_trending)))
+    app.state.ready = True
+    finished = time.perf_counter()
+    startup_seconds.set(started - IMPORT_STARTED, ("import",))
+    startup_seconds.set(finished - started, ("startup",))
+    logger.info(
+        "worker %d ready in %.0fms (import %.0fms, startup %.0fms)",
+        os.getpid(), (finished - IMPORT_STARTED) * 1000, (started - IMPORT_STARTED) * 1000, (finished - started) * 1000,
+    )
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def warm_caches():
+    # a failure here only means the first request pays for it
+    results = await asyncio.gather(
+        refresh_trending(),
+        run_in_threadpool(load_legal_text),
+        run_in_threadpool(hasher.load_backend),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("warming up failed: %r", result)
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.ready = False
+    # songs being transcoded go back to pending and are queued again on the next start
+    await transcoder.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await flush_downloads()
+
+async def repeat(seconds: float, job):
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            await job()
+        except Exception:
+            logger.exception("%s failed", job.__name__)
+
+async def flush_downloads():
+    counts = download_counter.drain()
+    if not counts:
+        return
+    try:
+        async with open_session() as db:
+            await run_db(db, crud.record_downloads, counts, datetime.utcnow().date())
+    except BaseException:
+        download_counter.restore(counts)
+        raise
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def refresh_trending():
+    async with open_session() as db:
+        await run_db(db, trending_ranking.refresh)
 
-def authenticate_user(username: str, password: str, db: Session = Depends(get_db)):
-    user = crud.get_user_by_username(db, username=username)
+# Dependencies
+async def authenticate_user(username: str, password: str, db: Session = Depends(get_db)):
+    user = await run_db(db, crud.get_user_by_username, username=username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    if not await hasher.verify_async(password, user.hashed_password):
         return False
     return user
 
+def hasher_busy_exception():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Too many logins in progress, try again later",
+        headers={"Retry-After": "1"},
+    )
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -91,134 +221,195 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    encoded_jwt = jwt.encode(to_encode, get_settings().secret_key, algorithm=get_settings().algorithm)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+async def get_token_user(token: Optional[str], db: Session):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
+        payload = jwt.decode(token, get_settings().secret_key, algorithms=[get_settings().algorithm])
+        token_data = schemas.TokenData(username=payload.get("sub"), user_id=payload.get("uid"))
     except JWTError:
         raise credentials_exception
-    user = crud.get_user_by_username(db, username=token_data.username)
-    if user is None:
+    if token_data.username is None:
         raise credentials_exception
+    user = user_cache.get(token_data.username)
+    if user is None or (token_data.user_id is not None and user.id != token_data.user_id):
+        # tokens issued before the uid claim existed still go through the username
+        if token_data.user_id is not None:
+            db_user = await run_db(db, crud.get_user, user_id=token_data.user_id)
+            if db_user is not None and db_user.username != token_data.username:
+                db_user = None
+        else:
+            db_user = await run_db(db, crud.get_user_by_username, username=token_data.username)
+        if db_user is None:
+            raise credentials_exception
+        user = schemas.User.from_orm(db_user)
+        user_cache.set(token_data.username, user)
     return user
 
-async def get_current_user_optional(token: str = Depends(oauth2_scheme_optional), db: Session = Depends(get_db)):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"},
-    )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = schemas.TokenData(username=username)
-    except JWTError:
-        raise credentials_exception
-    except:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    return await get_token_user(token, db)
+
+async def get_current_user_optional(token: Optional[str] = Depends(oauth2_scheme_optional), db: Session = Depends(get_db)):
+    if token is None:
         return None
-    user = crud.get_user_by_username(db, username=token_data.username)
-    if user is None:
-        raise credentials_exception
-    return user
+    return await get_token_user(token, db)
 
 @app.get("/")
 async def docs_redirect():
     return RedirectResponse(url='/docs')
 
-@app.post("/token", response_model=schemas.Token, responses={**responses.UNAUTORIZED},tags=["auth"])
+@app.get("/health/live", include_in_schema=False)
+def liveness():
+    return {"status": "alive"}
+
+@app.get("/health/ready", include_in_schema=False)
+async def readiness(response: Response):
+    """
+    Ready once startup has finished and while the database answers, so a
+    load balancer only sends traffic to workers that can serve it.
+    """
+    if not app.state.ready:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "starting"}
+    try:
+        await asyncio.wait_for(run_with_connection(ping_database), READINESS_TIMEOUT)
+    except Exception:
+        logger.warning("readiness check failed", exc_info=True)
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        return {"status": "database unavailable"}
+    return {"status": "ready"}
+
+def ping_database(connection):
+    connection.execute(text("select 1"))
+
+@app.post("/token", response_model=schemas.Token, responses={**responses.UNAUTORIZED, **responses.SERVICE_BUSY},tags=["auth"])
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = authenticate_user(form_data.username, form_data.password, db)
+    try:
+        user = await authenticate_user(form_data.username, form_data.password, db)
+    except HasherBusy:
+        raise hasher_busy_exception()
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    access_token_expires = timedelta(minutes=get_settings().access_token_expire_minutes)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username, "uid": user.id}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/info", response_model=schemas.StoreInfo)
-def get_info(db: Session = Depends(get_db)):
+async def get_info(request: Request, db: Session = Depends(get_db)):
+    cached = response_cache.get(request)
+    if cached is not None:
+        return cached
     info = schemas.StoreInfo(
-        name=os.environ.get("STORE_NAME"),
-        description=os.environ.get("STORE_DESCRIPTION"),
-        total_songs=crud.get_total_songs(db)
+        name=get_settings().store_name,
+        description=get_settings().store_description,
+        total_songs=await run_db(db, crud.get_total_songs)
         )
-    return info
+    return response_cache.store(request, info)
 
-@app.post("/users/", response_model=schemas.User, responses={**responses.USER_ALREADY_REGISTERED}, tags=["users"])
-def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user = crud.get_user_by_username(db, username=user.username)
+@app.post("/users/", response_model=schemas.User, responses={**responses.USER_ALREADY_REGISTERED, **responses.SERVICE_BUSY}, tags=["users"])
+async def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
+    db_user = await run_db(db, crud.get_user_by_username, username=user.username)
     if db_user:
         raise HTTPException(status_code=400, detail="Username already registered")
-    return crud.create_user(db=db, user=user)
+    try:
+        user.password = await hasher.hash_async(user.password)
+    except HasherBusy:
+        raise hasher_busy_exception()
+    return await run_db(db, crud.create_user, user=user)
 
 
-@app.get("/users/", response_model=List[schemas.User], tags=["users"])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    users = crud.get_users(db, skip=skip, limit=limit)
+@app.get("/users/", response_model=List[schemas.User], responses={**responses.PAGINATED, **responses.INVALID_CURSOR}, tags=["users"])
+async def read_users(response: Response, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_db)):
+    after_id = pagination.decode_cursor("users", after)
+    users = await run_db(db, crud.get_users, skip=skip, limit=limit, after=after_id)
+    pagination.set_next_cursor(response, "users", users, limit)
     return users
 
 @app.get("/users/me", response_model=schemas.User, responses={**responses.UNAUTORIZED}, tags=["users"])
-async def read_current_user(current_user: schemas.User = Depends(get_current_user)):
-    return current_user
+async def read_current_user(current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    # the resolved user may come from the cache, counters are read fresh
+    return await run_db(db, crud.get_user, current_user.id)
 
-@app.put("/users/me", response_model=schemas.User, responses={**responses.UNAUTORIZED}, tags=["users"])
+@app.put("/users/me", response_model=schemas.User, responses={**responses.UNAUTORIZED, **responses.SERVICE_BUSY}, tags=["users"])
 async def update_user_info(user: schemas.UserUpdate, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
-    crud.update_user(db, user, current_user)
+    if user.password is not None:
+        try:
+            user.password = await hasher.hash_async(user.password)
+        except HasherBusy:
+            raise hasher_busy_exception()
+    return await run_db(db, crud.update_user, user, current_user)
 
 @app.get("/users/me/uploaded", response_model=List[schemas.Song], responses={**responses.UNAUTORIZED}, tags=["users"])
-def read_current_user_uploaded(skip: int = 0, limit: int = 100, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return current_user.songs_uploaded[skip:(limit + skip if limit is not None else None)]
+async def read_current_user_uploaded(skip: int = 0, limit: int = 100, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    return FastJSONResponse(await run_db(db, crud.get_songs_uploaded_by, current_user.id, skip=skip, limit=limit))
 
 @app.get("/users/me/favs", response_model=List[schemas.Song], responses={**responses.UNAUTORIZED}, tags=["users"])
-def read_current_user_favs(skip: int = 0, limit: int = 100, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    return current_user.songs_faved[skip:(limit + skip if limit is not None else None)]
+async def read_current_user_favs(skip: int = 0, limit: int = 100, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    return FastJSONResponse(await run_db(db, crud.get_songs_faved_by, current_user.id, skip=skip, limit=limit))
+
+def fav_results(results: dict):
+    return [schemas.FavResult(song_id=song_id, result=result) for song_id, result in results.items()]
+
+def check_favs_batch(*song_ids: List[int]):
+    if sum(len(ids) for ids in song_ids) > FAVS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"At most {FAVS_BATCH_MAX} song ids can be sent at once")
+
+@app.put("/users/me/favs", response_model=List[schemas.FavResult], responses={**responses.UNAUTORIZED, **responses.TOO_MANY_FAVS}, tags=["users"])
+async def replace_current_user_favs(song_ids: List[int], current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    """
+    Makes song_ids the whole favs list, unfaving everything else.
+    """
+    check_favs_batch(song_ids)
+    return fav_results(await run_db(db, crud.replace_favs, current_user.id, song_ids))
+
+@app.patch("/users/me/favs", response_model=List[schemas.FavResult], responses={**responses.UNAUTORIZED, **responses.FAVS_UPDATE}, tags=["users"])
+async def update_current_user_favs(favs: schemas.FavsUpdate, current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    check_favs_batch(favs.add, favs.remove)
+    both = sorted(set(favs.add) & set(favs.remove))
+    if both:
+        raise HTTPException(status_code=400, detail=f"Song ids both added and removed: {', '.join(map(str, both))}")
+    return fav_results(await run_db(db, crud.update_favs, current_user.id, add=favs.add, remove=favs.remove))
 
 @app.delete("/users/me", responses={**responses.UNAUTORIZED}, tags=["users"])
-def delete_current_user(current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
-    crud.delete_user(db, current_user.id)
+async def delete_current_user(current_user: schemas.User = Depends(get_current_user), db: Session = Depends(get_db)):
+    await run_db(db, crud.delete_user, current_user.id)
     return
 
 @app.get("/users/{user_id}", response_model=schemas.User, responses={**responses.ENTITY_NOT_FOUND}, tags=["users"])
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user(user_id: int, db: Session = Depends(get_db)):
+    db_user = await run_db(db, crud.get_user, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
 
 @app.get("/users/{user_id}/uploaded", response_model=List[schemas.Song], responses={**responses.ENTITY_NOT_FOUND}, tags=["users"])
-def read_current_user_uploaded(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user_uploaded(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    db_user = await run_db(db, crud.get_user, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user.songs_uploaded[skip:(limit + skip if limit is not None else None)]
+    return FastJSONResponse(await run_db(db, crud.get_songs_uploaded_by, user_id, skip=skip, limit=limit))
 
 @app.get("/users/{user_id}/favs", response_model=List[schemas.Song], responses={**responses.ENTITY_NOT_FOUND}, tags=["users"])
-def read_user_favs(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+async def read_user_favs(user_id: int, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    db_user = await run_db(db, crud.get_user, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
-    return db_user.songs_faved[skip:(limit + skip if limit is not None else None)]
+    return FastJSONResponse(await run_db(db, crud.get_songs_faved_by, user_id, skip=skip, limit=limit))
 
-@app.post("/songs/", response_model=schemas.Song, responses={**responses.INCORRECT_MEDIA_TYPE, **responses.UNAUTORIZED}, tags=["songs"])
-def create_song(
+@app.post("/songs/", response_model=schemas.Song, responses={**responses.INCORRECT_MEDIA_TYPE, **responses.UNAUTORIZED, **responses.UPLOAD_TOO_LARGE}, tags=["songs"])
+async def create_song(
     audio: UploadFile,
     art: UploadFile,
     song_info: UploadFile,
@@ -237,163 +428,308 @@ def create_song(
     # if song_info.content_type != "text/xml":
     #     raise HTTPException(status_code=415, detail="Media type must be text/xml")
 
-    xml = song_info.file.read()
-    root: ET.Element = ET.fromstring(xml)
-
+    saved = []
+    lease = functools.partial(run_db, db, crud.lease_blob)
     try:
-        song = schemas.SongCreateAPI(
-            song_name=root.findtext("title"),
-            author=root.findtext("artist"),
-            easy_diff_text=root.find("easy").attrib["difficulty"],
-            easy_diff_charter=root.find("easy").attrib["charter"],
-            normal_diff_text=root.find("normal").attrib["difficulty"],
-            normal_diff_charter=root.find("normal").attrib["charter"],
-            hard_diff_text=root.find("hard").attrib["difficulty"],
-            hard_diff_charter=root.find("hard").attrib["charter"],
-            song_art_artist=root.find("jacket").attrib["artist"],
-            uploader=current_user.id
+        xml = await uploads.read_upload(song_info, "song_info", UPLOAD_LIMITS["song_info"])
+        try:
+            root: ET.Element = ET.fromstring(xml)
+            song = schemas.SongCreateAPI(
+                song_name=root.findtext("title"),
+                author=root.findtext("artist"),
+                easy_diff_text=root.find("easy").attrib["difficulty"],
+                easy_diff_charter=root.find("easy").attrib["charter"],
+                normal_diff_text=root.find("normal").attrib["difficulty"],
+                normal_diff_charter=root.find("normal").attrib["charter"],
+                hard_diff_text=root.find("hard").attrib["difficulty"],
+                hard_diff_charter=root.find("hard").attrib["charter"],
+                song_art_artist=root.find("jacket").attrib["artist"],
+                uploader=current_user.id
+            )
+        except Exception:
+            raise HTTPException(415, "Song info XML not formed correctly")
+
+        saved.append(await blob_store.save_upload(audio, "audio", "audio", ".wav", UPLOAD_LIMITS["audio"], lease))
+        saved.append(await blob_store.save_upload(art, "art", "images", ".png", UPLOAD_LIMITS["art"], lease))
+
+        charts = {}
+        for field, chart in (("easy", easy), ("normal", normal), ("hard", hard)):
+            if chart:
+                charts[field] = await chart_files.save_chart(chart, field, UPLOAD_LIMITS["chart"], lease)
+                saved.append(charts[field])
+            else:
+                charts[field] = None
+
+        db_song = await run_db(
+            db, crud.create_song, song, saved[0], saved[1], charts["easy"], charts["normal"], charts["hard"]
         )
-    except:
-        raise HTTPException(415, "Song info XML not formed correctly")
-
-
-    file_audio = f"{uuid.uuid4().hex}.wav"
-    f = open(f"./storage/audio/{file_audio}", "wb")
-    f.write(audio.file.read())
-    f.close()
-    audio.close()
-
-    file_art = f"{uuid.uuid4().hex}.png"
-    f = open(f"./storage/images/{file_art}", "wb")
-    f.write(art.file.read())
-    f.close()
-    art.close()
-    
-    if easy:
-        file_easy = f"{uuid.uuid4().hex}.chart"
-        f = open(f"./storage/charts/{file_easy}", "wb")
-        f.write(easy.file.read())
-        f.close()
-        normal.close()
-    else:
-        file_easy = None
-    
-    if normal:
-        file_normal = f"{uuid.uuid4().hex}.chart"
-        f = open(f"./storage/charts/{file_normal}", "wb")
-        f.write(normal.file.read())
-        f.close()
-        normal.close()
-    else:
-        file_normal = None
-    
-    if hard:
-        file_hard = f"{uuid.uuid4().hex}.chart"
-        f = open(f"./storage/charts/{file_hard}", "wb")
-        f.write(hard.file.read())
-        f.close()
-        hard.close()
-    else:
-        file_hard = None
-
-    return crud.create_song(db, song, file_audio, file_art, file_easy, file_normal, file_hard)
+        transcoder.submit(db_song.id)
+        return db_song
+    except BaseException as e:
+        await run_db(db, discard_upload, saved)
+        if isinstance(e, uploads.UploadTooLarge):
+            raise HTTPException(413, f"Upload too large: {e.field} is limited to {e.max_bytes} bytes")
+        if isinstance(e, chart_files.InvalidChart):
+            raise HTTPException(415, f"Chart {e.field} is not valid: {e.reason}")
+        raise
+
+def discard_upload(db: Session, saved: List[StoredBlob]):
+    db.rollback()
+    crud.discard_unreferenced_blobs(db, saved)
+
+async def transcode_song(song_id: int):
+    async with open_session() as db:
+        source = await run_db(db, crud.get_song_asset, song_id, "audio")
+        # every worker queues the pending songs at startup, the first to claim one does it
+        if source is None or not await run_db(db, crud.claim_audio_job, song_id):
+            return
+        variants = {}
+        lease = functools.partial(run_db, db, crud.lease_blob)
+        try:
+            for audio_format in transcoder.formats:
+                variants[audio_format] = await transcode.encode_audio(blob_store.local_path("audio", source), audio_format, lease)
+            attached = await run_db(db, crud.add_audio_variants, song_id, variants)
+        except BaseException as e:
+            await run_db(db, discard_upload, list(variants.values()))
+            # a worker shutting down gives the song back, the next start picks it up again
+            status = "pending" if isinstance(e, asyncio.CancelledError) else "failed"
+            await run_db(db, crud.set_audio_status, song_id, status, expected="processing")
+            raise
+        if not attached:
+            await run_db(db, crud.discard_unreferenced_blobs, variants.values())
+
+transcoder = transcode.TranscodeQueue(
+    transcode_song,
+    formats=[audio_format.strip() for audio_format in os.environ.get("TRANSCODE_FORMATS", "ogg,mp3").split(",")],
+    workers=int(os.environ.get("TRANSCODE_WORKERS", 2)),
+)
     
-@app.get("/songs/", response_model=List[schemas.Song], tags=["songs"])
-def read_songs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
+@app.get("/songs/", response_model=List[schemas.Song], responses={**responses.PAGINATED, **responses.INVALID_CURSOR}, tags=["songs"])
+async def read_songs(request: Request, skip: int = 0, limit: int = 100, after: Optional[str] = None, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
+    after_id = pagination.decode_cursor("songs", after)
     if user:
-        songs = crud.get_songs_auth(db, user, skip=skip, limit=limit)
-    else:  
-        songs = crud.get_songs(db, skip=skip, limit=limit)
-    return songs
+        songs = await run_db(db, crud.get_songs, user, skip=skip, limit=limit, after=after_id)
+        return FastJSONResponse(songs, headers=pagination.next_cursor_headers("songs", songs, limit))
+    cached = response_cache.get(request)
+    if cached is not None:
+        return cached
+    songs = await run_db(db, crud.get_songs, skip=skip, limit=limit, after=after_id)
+    return response_cache.store(request, songs, pagination.next_cursor_headers("songs", songs, limit))
+
+@app.get("/sync", response_model=schemas.CatalogueDelta, tags=["songs"])
+async def sync_catalogue(since: int = 0, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
+    """
+    Songs added, changed or removed after a version returned by an earlier
+    call, starting from 0. Signed in, changes to the user's favs are included.
+    While more is true the client should ask again with the new version.
+    """
+    return FastJSONResponse(await run_db(db, crud.get_changes, since, user=user, limit=SYNC_MAX_SONGS))
+
+@app.get("/songs/trending", response_model=List[schemas.Song], tags=["songs"])
+async def read_trending_songs(skip: int = 0, limit: int = 100, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
+    """
+    Songs ranked by recent downloads and favs, newer ones weighing more. The
+    ranking is recomputed every few minutes, not per request.
+    """
+    return FastJSONResponse(await run_db(db, crud.get_songs_ranked, trending_ranking.top(skip, limit), user))
+
+@app.get("/songs/search", response_model=List[schemas.Song], tags=["songs"])
+async def search_songs(
+    q: Optional[str] = None,
+    level: Optional[schemas.Difficulty] = None,
+    difficulty: Optional[str] = None,
+    charter: Optional[str] = None,
+    min_difficulty: Optional[float] = None,
+    max_difficulty: Optional[float] = None,
+    skip: int = 0,
+    limit: int = 100,
+    db: Session = Depends(get_db),
+    user: schemas.User = Depends(get_current_user_optional)
+    ):
+    """
+    Searches song name, author, charters and jacket artist, every word of q
+    matching as a prefix, best matches first. level, difficulty, charter
+    and the difficulty range restrict the results to songs with a matching chart.
+    """
+    return await run_db(
+        db, crud.search_songs, q, level=level, difficulty=difficulty, charter=charter,
+        min_difficulty=min_difficulty, max_difficulty=max_difficulty, user=user, skip=skip, limit=limit
+    )
+
+@app.get("/songs/bundle", responses={**responses.ENTITY_NOT_FOUND, **responses.TOO_MANY_SONGS, **responses.BUNDLE}, tags=["songs"])
+async def get_songs_bundle(ids: List[int] = Query(...), db: Session = Depends(get_db)):
+    song_ids = sorted(set(ids))
+    if len(song_ids) > BUNDLE_MAX_SONGS:
+        raise HTTPException(status_code=400, detail=f"At most {BUNDLE_MAX_SONGS} songs can be bundled at once")
+    db_songs = await run_db(db, crud.get_songs_by_ids, song_ids)
+    if len(db_songs) != len(song_ids):
+        raise HTTPException(status_code=404, detail="Song not found")
+    return bundle.bundle_response(db_songs, "songs.tar", prefix_ids=True)
 
 @app.get("/songs/{song_id}", response_model=schemas.Song, responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song(song_id: str, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
+async def get_song(song_id: str, request: Request, db: Session = Depends(get_db), user: schemas.User = Depends(get_current_user_optional)):
     if user:
-        db_song = crud.get_song_auth(db=db, song_id=song_id, user=user)
-    else:
-        db_song = crud.get_song(db=db, song_id=song_id)
+        db_song = await run_db(db, crud.get_song_auth, song_id=song_id, user=user)
+        if db_song is None:
+            raise HTTPException(status_code=404, detail="Song not found")
+        return db_song
+    cached = response_cache.get(request)
+    if cached is not None:
+        return cached
+    db_song = await run_db(db, crud.get_song, song_id=song_id)
     if db_song is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    return db_song
+    return response_cache.store(request, schemas.Song.from_orm(db_song))
 
-@app.get("/songs/{song_id}/jacket", responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song_jacket(song_id: str, db: Session = Depends(get_db)):
-    db_song = crud.get_song(db=db, song_id=song_id)
+@app.get("/songs/{song_id}/bundle", responses={**responses.ENTITY_NOT_FOUND, **responses.BUNDLE}, tags=["songs"])
+async def get_song_bundle(song_id: int, db: Session = Depends(get_db)):
+    db_song = await run_db(db, crud.get_song, song_id=song_id)
     if db_song is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    return FileResponse(f"./storage/images/{db_song.song_art[0]}")
-
-@app.get("/songs/{song_id}/audio", responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song_audio(song_id: str, db: Session = Depends(get_db)):
-    db_song = crud.get_song(db=db, song_id=song_id)
-    if db_song is None:
+    return bundle.bundle_response([db_song], f"song-{song_id}.tar")
+
+@app.get("/songs/{song_id}/jacket", responses={**responses.ENTITY_NOT_FOUND, **responses.ASSET, **responses.THUMBNAIL_SIZE}, tags=["songs"])
+async def get_song_jacket(song_id: int, request: Request, size: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    size returns the jacket scaled down to fit a size x size box, re-encoded
+    for grid views. Only the configured sizes are rendered.
+    """
+    if size is not None and size not in thumbnail_cache.sizes:
+        raise HTTPException(status_code=400, detail=f"size must be one of {', '.join(map(str, thumbnail_cache.sizes))}")
+    jacket = await run_db(db, crud.get_song_asset, song_id, "jacket")
+    if jacket is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    return FileResponse(f"./storage/audio/{db_song.music}")
-
-@app.get("/songs/{song_id}/easy", responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song_easy(song_id: str, db: Session = Depends(get_db)):
-    db_song = crud.get_song(db=db, song_id=song_id)
-    if db_song is None:
+    path = blob_store.local_path("images", jacket)
+    if size is not None:
+        try:
+            path = await thumbnail_cache.get(path, jacket, size)
+        except ThumbnailError:
+            raise HTTPException(status_code=415, detail="Jacket cannot be resized")
+    return serve.asset_response(request, path)
+
+@app.get("/songs/{song_id}/audio", responses={**responses.ENTITY_NOT_FOUND, **responses.ASSET}, tags=["songs"])
+async def get_song_audio(song_id: int, request: Request, format: Optional[schemas.AudioFormat] = None, db: Session = Depends(get_db)):
+    """
+    Serves a compressed variant when one is asked for through format or
+    Accept and has been produced already, the uploaded wav otherwise.
+    """
+    formats = transcode.negotiate(format.value if format else None, request.headers.get("accept"))
+    found = await run_db(db, crud.get_song_audio, song_id, formats)
+    if found is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    return FileResponse(f"./storage/charts/{db_song.easy_diff[1]}")
+    audio_format, audio = found
+    # only the format asked for first is final, anything else may be replaced once transcoded
+    exact = not formats or audio_format == formats[0]
+    response = serve.asset_response(
+        request, blob_store.local_path("audio", audio), cache_control=serve.CACHE_CONTROL if exact else serve.REVALIDATE
+    )
+    response.headers["Vary"] = "Accept"
+    count_download(response, song_id, "audio")
+    return response
+
+async def chart_response(request: Request, db: Session, song_id: int, difficulty: str):
+    chart = await run_db(db, crud.get_song_asset, song_id, difficulty)
+    if chart is None:
+        raise HTTPException(status_code=404, detail="Song or chart not found")
+    response = await run_in_threadpool(chart_files.chart_response, request, blob_store.local_path("charts", chart))
+    count_download(response, song_id, "charts")
+    return response
+
+def count_download(response: Response, song_id: int, kind: str):
+    # revalidations and resumed transfers are not new downloads
+    if response.status_code == 200 or (
+        response.status_code == 206 and response.headers["Content-Range"].startswith("bytes 0-")
+    ):
+        download_counter.hit(song_id, kind)
 
-@app.get("/songs/{song_id}/normal", responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song_normal(song_id: str, db: Session = Depends(get_db)):
-    db_song = crud.get_song(db=db, song_id=song_id)
-    if db_song is None:
-        raise HTTPException(status_code=404, detail="Song not found")
-    return FileResponse(f"./storage/charts/{db_song.normal_diff[1]}")
+@app.get("/songs/{song_id}/easy", responses={**responses.ENTITY_NOT_FOUND, **responses.ASSET}, tags=["songs"])
+async def get_song_easy(song_id: int, request: Request, db: Session = Depends(get_db)):
+    return await chart_response(request, db, song_id, "easy")
 
-@app.get("/songs/{song_id}/hard", responses={**responses.ENTITY_NOT_FOUND}, tags=["songs"])
-def get_song_hard(song_id: str, db: Session = Depends(get_db)):
-    db_song = crud.get_song(db=db, song_id=song_id)
-    if db_song is None:
-        raise HTTPException(status_code=404, detail="Song not found")
-    return FileResponse(f"./storage/charts/{db_song.hard_diff[1]}")
+@app.get("/songs/{song_id}/normal", responses={**responses.ENTITY_NOT_FOUND, **responses.ASSET}, tags=["songs"])
+async def get_song_normal(song_id: int, request: Request, db: Session = Depends(get_db)):
+    return await chart_response(request, db, song_id, "normal")
+
+@app.get("/songs/{song_id}/hard", responses={**responses.ENTITY_NOT_FOUND, **responses.ASSET}, tags=["songs"])
+async def get_song_hard(song_id: int, request: Request, db: Session = Depends(get_db)):
+    return await chart_response(request, db, song_id, "hard")
 
 @app.put("/songs/{song_id}/fav", response_model=schemas.SongStatus, responses={**responses.ENTITY_NOT_FOUND, **responses.UNAUTORIZED}, tags=["songs"])
-def fav_song(song_id: str, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
-    db_song = crud.get_song(db=db, song_id=song_id)
+async def fav_song(song_id: int, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
+    db_song = await run_db(db, crud.get_song, song_id=song_id)
     if db_song is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    if crud.fav_song(db, current_user.id, song_id):
+    # built before the commit expires the song
+    song = schemas.Song.from_orm(db_song)
+    if await run_db(db, crud.fav_song, current_user.id, song_id):
         fav_status = schemas.SongStatus(
-            song = db_song,
+            song = song,
             status = schemas.FavStatus.FAVED
         )
     else:
        fav_status = schemas.SongStatus(
-            song = db_song,
+            song = song,
             status = schemas.FavStatus.FAV_ERROR
         ) 
     return fav_status
     
 @app.put("/songs/{song_id}/unfav", response_model=schemas.SongStatus, responses={**responses.ENTITY_NOT_FOUND, **responses.UNAUTORIZED}, tags=["songs"])
-def unfav_song(song_id: str, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
-    db_song = crud.get_song(db=db, song_id=song_id)
+async def unfav_song(song_id: int, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
+    db_song = await run_db(db, crud.get_song, song_id=song_id)
     if db_song is None:
         raise HTTPException(status_code=404, detail="Song not found")
-    if crud.unfav_song(db, current_user.id, song_id):
+    song = schemas.Song.from_orm(db_song)
+    if await run_db(db, crud.unfav_song, current_user.id, song_id):
         fav_status = schemas.SongStatus(
-            song = db_song,
+            song = song,
             status = schemas.FavStatus.UNFAVED
         )
     else:
        fav_status = schemas.SongStatus(
-            song = db_song,
+            song = song,
             status = schemas.FavStatus.FAV_ERROR
         ) 
     return fav_status
 
 @app.delete("/songs/{song_id}", responses={**responses.ENTITY_NOT_FOUND, **responses.UNAUTORIZED}, tags=["songs"])
-def delete_song(song_id: int, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
-    db_song: models.Song = crud.get_song(db, song_id)
-    if db_song.uploader is not current_user.id:
+async def delete_song(song_id: int, db: Session = Depends(get_db), current_user: schemas.User = Depends(get_current_user)):
+    db_song: models.Song = await run_db(db, crud.get_song, song_id)
+    if db_song is None:
+        raise HTTPException(status_code=404, detail="Song not found")
+    if db_song.uploader != current_user.id:
         raise HTTPException(status_code=401, detail="User did not upload this song")
-    crud.delete_song(db, song_id)
+    await run_db(db, crud.delete_song, song_id)
 
-@app.get("/legal", response_model=schemas.Legal, tags=["legal"])
-def get_legal(db: Session = Depends(get_db)):
+@functools.lru_cache(maxsize=None)
+def load_legal_text():
     with open("static/legal.text", "r") as f:
-        text = f.read()
-    return schemas.Legal(text=text)
+        return f.read()
+
+@app.get("/legal", response_model=schemas.Legal, tags=["legal"])
+def get_legal(request: Request):
+    cached = response_cache.get(request)
+    if cached is not None:
+        return cached
+    return response_cache.store(request, schemas.Legal(text=load_legal_text()))
+
+def register_metrics():
+    # counters other parts of the app already keep, read on each scrape
+    def hasher_stat(name):
+        return lambda: hasher.stats()[name]
+    registry.callback_gauge("password_hash_queued", "Password hashes waiting for a worker.", hasher_stat("queued"))
+    registry.callback_gauge("password_hash_running", "Password hashes being computed.", hasher_stat("running"))
+    registry.callback_counter("password_hash_total", "Password hashes and verifications done.", hasher_stat("completed"))
+    registry.callback_counter("password_hash_rejected_total", "Password hashes refused because the queue was full.", hasher_stat("rejected"))
+    registry.callback_counter("password_hash_seconds_total", "Time spent in bcrypt.", hasher_stat("busy_seconds"))
+    registry.callback_gauge("transcode_queue_length", "Songs waiting to be transcoded.", transcoder.pending)
+    registry.callback_gauge("downloads_unflushed", "Downloads counted but not written to the database yet.", download_counter.pending)
+    if hasattr(engine.pool, "checkedout"):
+        registry.callback_gauge("db_pool_checked_out", "Database connections in use.", engine.pool.checkedout)
+
+register_metrics()
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    return Response(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,106 @@
+import logging
+import time
+
+from typing import Dict, Optional
+
+from starlette.routing import Mount
+
+from .registry import registry
+from .requests import RequestStats, current_request
+
+logger = logging.getLogger(__name__)
+
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+# requests that matched no route share a label, so scanners cannot grow the label set
+UNMATCHED = "unmatched"
+
+requests_total = registry.counter("http_requests_total", "Requests answered.", ["method", "route", "status"])
+request_seconds = registry.histogram("http_request_duration_seconds", "Time until the last byte of the response was sent.", ["method", "route"])
+request_queries = registry.histogram("http_request_db_queries", "SQL statements executed per request.", ["method", "route"], QUERY_COUNT_BUCKETS)
+request_query_seconds = registry.histogram("http_request_db_seconds", "Time spent in SQL statements per request.", ["method", "route"])
+request_bytes = registry.counter("http_request_body_bytes_total", "Request body bytes received, uploads included.", ["method", "route"])
+response_bytes = registry.counter("http_response_body_bytes_total", "Response body bytes sent, downloads included.", ["method", "route"])
+in_flight = registry.gauge("http_requests_in_flight", "Requests being handled right now.")
+
+
+class MetricsMiddleware:
+    """
+    Records latency, status, body sizes and SQL statements of every request,
+    labelled with the route template rather than the path so song ids do not
+    each become a series. Requests slower than slow_seconds are logged along
+    with the statements they ran.
+    """
+
+    def __init__(self, app, router, slow_seconds: Optional[float] = None):
+        self.app = app
+        self.router = router
+        self.slow_seconds = slow_seconds
+        self._route_names: Optional[Dict[object, str]] = None
+
+    def route_name(self, scope) -> str:
+        if self._route_names is None:
+            # built on first use, when every route has been added
+            self._route_names = {}
+            for route in self.router.routes:
+                if isinstance(route, Mount):
+                    self._route_names[route.app] = f"{route.path}/{{path}}"
+                elif hasattr(route, "endpoint"):
+                    self._route_names[route.endpoint] = route.path
+        return self._route_names.get(scope.get("endpoint"), UNMATCHED)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(keep_statements=self.slow_seconds is not None)
+        token = current_request.set(stats)
+        status = 500
+        received = 0
+        sent = 0
+
+        async def counting_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+            return message
+
+        async def counting_send(message):
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, counting_receive, counting_send)
+        finally:
+            elapsed = time.perf_counter() - started
+            in_flight.dec()
+            current_request.reset(token)
+            method = scope["method"]
+            route = self.route_name(scope)
+            labels = (method, route)
+            requests_total.inc(labels=(method, route, str(status)))
+            request_seconds.observe(elapsed, labels)
+            request_queries.observe(stats.queries, labels)
+            request_query_seconds.observe(stats.query_seconds, labels)
+            request_bytes.inc(received, labels)
+            response_bytes.inc(sent, labels)
+            if self.slow_seconds is not None and elapsed >= self.slow_seconds:
+                self.log_slow(method, scope["path"], route, status, elapsed, stats)
+
+    def log_slow(self, method: str, path: str, route: str, status: int, elapsed: float, stats: RequestStats):
+        lines = [
+            f"slow request {method} {path} ({route}) {status} took {elapsed * 1000:.1f}ms, "
+            f"{stats.queries} queries in {stats.query_seconds * 1000:.1f}ms"
+        ]
+        for seconds, statement in stats.statements:
+            lines.append(f"  {seconds * 1000:8.1f}ms  {' '.join(statement.split())}")
+        if stats.queries > len(stats.statements):
+            lines.append(f"  ... and {stats.queries - len(stats.statements)} more")
+        logger.warning("\n".join(lines))
@@ -0,0 +1,49 @@
+import contextvars
+
+from typing import List, Optional, Tuple
+
+from .registry import registry
+
+# the slow request log keeps this much of each statement
+STATEMENT_LOG_LENGTH = 500
+# and at most this many statements of one request
+STATEMENT_LOG_MAX = 100
+
+db_queries = registry.counter("db_queries_total", "SQL statements executed, background jobs included.")
+db_query_seconds = registry.counter("db_query_seconds_total", "Time spent executing SQL statements.")
+db_query_errors = registry.counter("db_query_errors_total", "SQL statements that raised.")
+
+
+class RequestStats:
+    """
+    What one request did, filled in as it goes. The object is shared with
+    threadpool workers through a context variable, so sessions running off the
+    event loop add to the same stats.
+    """
+
+    __slots__ = ("queries", "query_seconds", "statements")
+
+    def __init__(self, keep_statements: bool):
+        self.queries = 0
+        self.query_seconds = 0.0
+        # (seconds, statement), only kept when something will log them
+        self.statements: Optional[List[Tuple[float, str]]] = [] if keep_statements else None
+
+
+current_request: contextvars.ContextVar[Optional[RequestStats]] = contextvars.ContextVar("current_request", default=None)
+
+
+def record_query(statement: str, seconds: float):
+    db_queries.inc()
+    db_query_seconds.inc(seconds)
+    stats = current_request.get()
+    if stats is None:
+        return
+    stats.queries += 1
+    stats.query_seconds += seconds
+    if stats.statements is not None and len(stats.statements) < STATEMENT_LOG_MAX:
+        stats.statements.append((seconds, statement[:STATEMENT_LOG_LENGTH]))
+
+
+def record_query_error():
+    db_query_errors.inc()
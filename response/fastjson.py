@@ -0,0 +1,38 @@
+import json
+
+from typing import Any
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encodes plain dicts, lists, strings and numbers directly, orjson when it is
+    installed, and only hands anything else (pydantic models, ORM objects with
+    orm_mode schemas) to jsonable_encoder.
+    """
+    if orjson is not None:
+        return orjson.dumps(content, default=jsonable_encoder)
+    return json.dumps(
+        content,
+        default=jsonable_encoder,
+        ensure_ascii=False,
+        allow_nan=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """
+    Returned straight from a handler, this skips the response_model validation
+    and jsonable_encoder pass FastAPI would otherwise run on the content.
+    """
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
@@ -0,0 +1,42 @@
+import base64
+import binascii
+
+from typing import Optional, Sequence
+
+from fastapi import HTTPException, Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(kind: str, last_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{kind}:{last_id}".encode()).decode().rstrip("=")
+
+
+def decode_cursor(kind: str, cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_kind, last_id = base64.urlsafe_b64decode(padded).decode().split(":", 1)
+        if cursor_kind != kind:
+            raise ValueError(cursor_kind)
+        return int(last_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def next_cursor(kind: str, page: Sequence, limit: int) -> Optional[str]:
+    # a short page means there is nothing after it
+    if page and len(page) == limit:
+        last = page[-1]
+        return encode_cursor(kind, last["id"] if isinstance(last, dict) else last.id)
+    return None
+
+
+def next_cursor_headers(kind: str, page: Sequence, limit: int) -> dict:
+    cursor = next_cursor(kind, page, limit)
+    return {NEXT_CURSOR_HEADER: cursor} if cursor is not None else {}
+
+
+def set_next_cursor(response: Response, kind: str, page: Sequence, limit: int):
+    response.headers.update(next_cursor_headers(kind, page, limit))
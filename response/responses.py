@@ -29,4 +29,87 @@ INCORRECT_MEDIA_TYPE = {
         "model": HTTPException,
         "description": "Incorrect media type provided."
     }
-}
\ No newline at end of file
+}
+
+INVALID_CURSOR = {
+    400: {
+        "model": HTTPException,
+        "description": "Pagination cursor is malformed or belongs to another listing."
+    }
+}
+
+PAGINATED = {
+    200: {
+        "description": "Successful response. When more rows are available, the "
+        "X-Next-Cursor header carries the token to pass as `after` for the next page.",
+        "headers": {
+            "X-Next-Cursor": {
+                "description": "Opaque cursor for the next page.",
+                "schema": {"type": "string"}
+            }
+        }
+    }
+}
+
+SERVICE_BUSY = {
+    503: {
+        "model": HTTPException,
+        "description": "Server is saturated with password hashing work, retry after the indicated delay."
+    }
+}
+
+UPLOAD_TOO_LARGE = {
+    413: {
+        "model": HTTPException,
+        "description": "One of the uploaded files is over its size limit."
+    }
+}
+
+ASSET = {
+    206: {
+        "description": "Requested byte range of the file."
+    },
+    304: {
+        "description": "The cached copy identified by If-None-Match or If-Modified-Since is still valid."
+    },
+    416: {
+        "model": HTTPException,
+        "description": "Requested range is outside of the file."
+    }
+}
+
+TOO_MANY_SONGS = {
+    400: {
+        "model": HTTPException,
+        "description": "More songs were requested than the server allows at once."
+    }
+}
+
+BUNDLE = {
+    200: {
+        "description": "Uncompressed tar with song.xml, audio.wav, jacket.png and the uploaded charts. "
+        "Multi-song bundles put each song under a directory named after its id.",
+        "content": {"application/x-tar": {}}
+    }
+}
+
+THUMBNAIL_SIZE = {
+    400: {
+        "model": HTTPException,
+        "description": "size is not one of the thumbnail sizes the store renders."
+    }
+}
+
+TOO_MANY_FAVS = {
+    400: {
+        "model": HTTPException,
+        "description": "More song ids were sent than the server takes in one request."
+    }
+}
+
+FAVS_UPDATE = {
+    400: {
+        "model": HTTPException,
+        "description": "More song ids were sent than the server takes in one request, or an id is both added and removed."
+    }
+}
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from passlib.context import CryptContext
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher:
+    """
+    Runs bcrypt on a small dedicated thread pool so it never blocks the event
+    loop or starves the request threadpool. Work beyond max_queue waiting jobs
+    is rejected with HasherBusy instead of piling up.
+    """
+
+    def __init__(self, max_workers: int = 2, max_queue: int = 64):
+        self.context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+
+    def _run(self, fn, *args):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+        started = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.busy_seconds += time.perf_counter() - started
+
+    def _submit(self, fn, *args) -> Future:
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                raise HasherBusy()
+            self.queued += 1
+        future = self._executor.submit(self._run, fn, *args)
+        # a cancelled caller cancels the job before _run takes it off the queue
+        future.add_done_callback(self._release_cancelled)
+        return future
+
+    def _release_cancelled(self, future: Future):
+        if future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def hash_async(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(self.context.hash, password))
+
+    async def verify_async(self, password: str, hashed_password: str) -> bool:
+        return await asyncio.wrap_future(self._submit(self.context.verify, password, hashed_password))
+
+    def load_backend(self):
+        # imports and self-tests bcrypt now instead of during the first login
+        self.context.handler().get_backend()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "busy_seconds": self.busy_seconds,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
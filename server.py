@@ -0,0 +1,157 @@
+"""
+Production entrypoint. Checks the settings, brings the schema up to date
+once, then starts the workers, which skip the schema work themselves:
+
+    python server.py serve --workers 4
+    python server.py migrate
+    python server.py check
+    python server.py recover
+
+`uvicorn main:app` keeps working for development, with every worker
+initializing the schema on its own.
+"""
+import argparse
+import asyncio
+import copy
+import logging
+import os
+import sys
+import time
+
+from pydantic import ValidationError
+
+from settings import Settings, describe_errors, get_settings
+
+logger = logging.getLogger("server")
+
+
+def load_settings() -> Settings:
+    try:
+        return get_settings()
+    except ValidationError as e:
+        print("invalid configuration, check .env or the environment:", file=sys.stderr)
+        for problem in describe_errors(e):
+            print(f"  {problem}", file=sys.stderr)
+        sys.exit(2)
+
+
+def log_config() -> dict:
+    # uvicorn's own logging, plus a root handler so the app's loggers show up too
+    from uvicorn.config import LOGGING_CONFIG
+
+    config = copy.deepcopy(LOGGING_CONFIG)
+    config["root"] = {"handlers": ["default"], "level": "INFO"}
+    return config
+
+
+async def prepare_database(apply_schema: bool):
+    # imported here so a configuration error is reported before the database is touched
+    from db.database import DB_ASYNC, engine, run_with_connection
+    from db.schema import init_schema, missing_columns, missing_tables
+
+    try:
+        if apply_schema:
+            await run_with_connection(init_schema)
+        else:
+            missing = []
+
+            def inspect(connection):
+                missing.extend(missing_tables(connection))
+                missing.extend(missing_columns(connection))
+            await run_with_connection(inspect)
+            if missing:
+                raise RuntimeError(f"database is missing {', '.join(missing)}")
+    finally:
+        # the workers open their own connections
+        if DB_ASYNC:
+            await engine.dispose()
+        else:
+            engine.dispose()
+
+
+def migrate():
+    started = time.perf_counter()
+    asyncio.run(prepare_database(apply_schema=True))
+    logger.info("schema ready in %.0fms", (time.perf_counter() - started) * 1000)
+
+
+def check():
+    """
+    Validates the settings and that the database is reachable and up to
+    date, without changing anything. Suitable for a deploy pipeline.
+    """
+    asyncio.run(prepare_database(apply_schema=False))
+    logger.info("configuration and database schema are fine")
+
+
+def recover():
+    """
+    Releases what killed workers left half done: the leases of their
+    unfinished uploads and the songs they were transcoding. Run it only
+    while no worker of any instance is running, it cannot tell an abandoned
+    upload from one still in progress.
+    """
+    from db.database import DB_ASYNC, engine, run_with_connection
+    from db.schema import recover_interrupted
+
+    async def run():
+        try:
+            await run_with_connection(recover_interrupted)
+        finally:
+            if DB_ASYNC:
+                await engine.dispose()
+            else:
+                engine.dispose()
+    asyncio.run(run())
+    logger.info("released the work of stopped workers")
+
+
+def serve(settings: Settings, args):
+    import uvicorn
+
+    if not args.skip_migrate:
+        migrate()
+    # inherited by the workers, which then leave the schema alone
+    os.environ["INIT_SCHEMA"] = "false"
+    workers = args.workers or settings.workers
+    logger.info("starting %d worker(s) on %s:%d", workers, args.host or settings.host, args.port or settings.port)
+    uvicorn.run(
+        "main:app",
+        host=args.host or settings.host,
+        port=args.port or settings.port,
+        workers=workers,
+        log_config=log_config(),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="prepare the database once and start the workers")
+    serve_parser.add_argument("--host", help="defaults to SERVER_HOST")
+    serve_parser.add_argument("--port", type=int, help="defaults to SERVER_PORT")
+    serve_parser.add_argument("--workers", type=int, help="defaults to WEB_CONCURRENCY")
+    serve_parser.add_argument("--skip-migrate", action="store_true", help="assume the schema is already up to date")
+    commands.add_parser("migrate", help="create missing tables and indexes and check for unapplied migrations")
+    commands.add_parser("check", help="validate the settings and the database schema without changing anything")
+    commands.add_parser("recover", help="release the uploads and transcodes of killed workers, only while none run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s:     %(message)s")
+    settings = load_settings()
+    try:
+        if args.command == "serve":
+            serve(settings, args)
+        elif args.command == "migrate":
+            migrate()
+        elif args.command == "recover":
+            recover()
+        else:
+            check()
+    except Exception as e:
+        logger.error("%s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
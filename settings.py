@@ -0,0 +1,73 @@
+import functools
+
+from typing import List
+
+import dotenv
+
+from pydantic import BaseSettings, Field, ValidationError, validator
+
+# .env is loaded once, here, before any module reads os.environ. Variables
+# already set in the environment win over the file.
+dotenv.load_dotenv()
+
+JWT_ALGORITHMS = ("HS256", "HS384", "HS512")
+
+
+class Settings(BaseSettings):
+    """
+    The settings the API cannot run without, checked once instead of failing
+    on first use. Fields are read from the environment variable of the same
+    name in upper case unless another is given. Optional tuning knobs stay with the modules they
+    tune.
+    """
+
+    secret_key: str
+    algorithm: str
+    access_token_expire_minutes: int
+    store_name: str
+    store_description: str = ""
+
+    # python server.py serve
+    host: str = Field("127.0.0.1", env="SERVER_HOST")
+    port: int = Field(8000, env="SERVER_PORT")
+    # the variable uvicorn and most process managers already use for this
+    workers: int = Field(1, env="WEB_CONCURRENCY")
+    # workers started by server.py leave the schema to the supervisor
+    init_schema: bool = True
+
+    @validator("secret_key", "store_name")
+    def not_blank(cls, value):
+        if not value.strip():
+            raise ValueError("must not be empty")
+        return value
+
+    @validator("algorithm")
+    def algorithm_supported(cls, value):
+        if value not in JWT_ALGORITHMS:
+            # tokens are signed with SECRET_KEY, which only the HMAC algorithms use
+            raise ValueError(f"must be one of {', '.join(JWT_ALGORITHMS)}")
+        return value
+
+    @validator("access_token_expire_minutes", "port", "workers")
+    def positive(cls, value):
+        if value <= 0:
+            raise ValueError("must be positive")
+        return value
+
+
+@functools.lru_cache(maxsize=None)
+def get_settings() -> Settings:
+    return Settings()
+
+
+
+def describe_errors(error: ValidationError) -> List[str]:
+    """
+    The problems in error, named by environment variable rather than field.
+    """
+    problems = []
+    for entry in error.errors():
+        field = Settings.__fields__[entry["loc"][0]]
+        variable = sorted(field.field_info.extra["env_names"])[0].upper()
+        problems.append(f"{variable}: {entry['msg']}")
+    return problems
@@ -0,0 +1,95 @@
+"""
+Runs the app in-process, through httpx's ASGI transport, against a SQLite
+file in a temporary directory. The environment is set up before main is
+imported, since most modules read it at import. Needs
+`pip install pytest httpx`.
+"""
+import os
+import shutil
+import sys
+import tempfile
+
+from datetime import timedelta
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+WORKDIR = tempfile.mkdtemp(prefix="songs-tests-")
+STORAGE_DIR = os.path.join(WORKDIR, "storage")
+os.environ.update(
+    DATABASE_URL=f"sqlite:///{os.path.join(WORKDIR, 'tests.db')}",
+    DB_ASYNC="false",
+    STORAGE_DIR=STORAGE_DIR,
+    # no ffmpeg jobs in the middle of a test
+    TRANSCODE_FORMATS="",
+    SECRET_KEY="tests" * 8,
+    ALGORITHM="HS256",
+    ACCESS_TOKEN_EXPIRE_MINUTES="60",
+    STORE_NAME="Test store",
+    INIT_SCHEMA="true",
+)
+
+# kept small, a test that needs more seeds it itself
+USERS = 20
+SONGS = 300
+
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(scope="session")
+async def client(anyio_backend):
+    import httpx
+
+    import main
+
+    await main.app.router.startup()
+    try:
+        seed_catalogue()
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            yield client
+    finally:
+        await main.app.router.shutdown()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+
+def seed_catalogue():
+    from bench import catalogue
+    from db.database import SessionLocal
+
+    with SessionLocal() as db:
+        catalogue.seed(db, STORAGE_DIR, users=USERS, songs=SONGS, favs_per_user=30, audio_kb=4)
+
+
+@pytest.fixture
+def auth_headers():
+    import main
+
+    def headers(user_id: int) -> dict:
+        # the catalogue names its users user<id>
+        token = main.create_access_token({"sub": f"user{user_id}", "uid": user_id}, timedelta(hours=1))
+        return {"Authorization": f"Bearer {token}"}
+    return headers
+
+
+@pytest.fixture
+def statements():
+    """
+    SQL statements run on the app's engine while the test runs.
+    """
+    from sqlalchemy import event
+
+    from db.database import engine
+
+    engine = getattr(engine, "sync_engine", engine)
+    executed = []
+
+    def record(connection, cursor, statement, parameters, context, executemany):
+        executed.append(statement)
+    event.listen(engine, "before_cursor_execute", record)
+    yield executed
+    event.remove(engine, "before_cursor_execute", record)
@@ -0,0 +1,74 @@
+"""
+Audio downloads with format negotiation. The catalogue has no transcoded
+variants, so asking for one gets the uploaded wav.
+"""
+import pytest
+
+from files import serve
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("params, headers", [
+    ({}, {}),
+    ({"format": "wav"}, {}),
+    ({}, {"Accept": "audio/wav, audio/ogg;q=0.5"}),
+])
+async def test_exact_audio_is_immutable(client, params, headers):
+    response = await client.get("/songs/2/audio", params=params, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == serve.CACHE_CONTROL
+
+
+@pytest.mark.parametrize("params, headers", [
+    ({"format": "ogg"}, {}),
+    ({}, {"Accept": "audio/ogg"}),
+    ({}, {"Accept": "audio/mpeg, audio/wav;q=0.5"}),
+])
+async def test_fallback_audio_is_revalidated(client, params, headers):
+    response = await client.get("/songs/2/audio", params=params, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["Cache-Control"] == serve.REVALIDATE
+    etag = response.headers["ETag"]
+    revalidated = await client.get("/songs/2/audio", params=params, headers={**headers, "If-None-Match": etag})
+    assert revalidated.status_code == 304
+    assert revalidated.headers["Cache-Control"] == serve.REVALIDATE
+
+
+async def test_transcode_job_is_claimed_once(client):
+    from db import crud
+    from db.database import SessionLocal
+
+    with SessionLocal() as db:
+        crud.set_audio_status(db, 3, "pending")
+        # every worker queues the song at startup
+        assert crud.claim_audio_job(db, 3)
+        assert not crud.claim_audio_job(db, 3)
+        assert 3 not in crud.get_songs_awaiting_audio(db)
+        # the worker died, python server.py recover gives the song back
+        crud.requeue_interrupted_audio_jobs(db)
+        assert 3 in crud.get_songs_awaiting_audio(db)
+        assert crud.claim_audio_job(db, 3)
+        crud.set_audio_status(db, 3, "ready")
+
+
+async def test_missing_variant_is_remembered(client, statements):
+    import functools
+
+    from db import crud
+    from db.database import SessionLocal, run_db
+    from files.blobs import blob_store
+
+    await client.get("/songs/4/audio", params={"format": "ogg"})
+    statements.clear()
+    response = await client.get("/songs/4/audio", params={"format": "ogg"})
+    assert response.status_code == 200
+    assert statements == []
+
+    with SessionLocal() as db:
+        lease = functools.partial(run_db, db, crud.lease_blob)
+        variant = await blob_store.save_bytes(b"OggS", "audio", "0" * 64 + ".ogg", lease)
+        assert crud.add_audio_variants(db, 4, {"ogg": variant})
+    response = await client.get("/songs/4/audio", params={"format": "ogg"})
+    assert response.content == b"OggS"
+    assert response.headers["Cache-Control"] == serve.CACHE_CONTROL
@@ -0,0 +1,92 @@
+"""
+A stored blob keeps its file while any upload still holds a lease on it,
+even if another upload of the same content fails or a collection runs.
+"""
+import functools
+import hashlib
+import os
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def store_chart(db, data: bytes):
+    from db import crud
+    from db.database import run_db
+    from files.blobs import blob_store
+
+    lease = functools.partial(run_db, db, crud.lease_blob)
+    return await blob_store.save_bytes(data, "charts", f"{hashlib.sha256(data).hexdigest()}.chart", lease)
+
+
+def blob_exists(blob):
+    from files.blobs import blob_store
+
+    return os.path.exists(blob_store.local_path(blob.kind, blob.name))
+
+
+async def test_failed_upload_keeps_leased_file(client):
+    from db import crud
+    from db.database import SessionLocal
+
+    data = os.urandom(512)
+    with SessionLocal() as db:
+        first = await store_chart(db, data)
+        # a second upload of the same content fails before the first commits
+        second = await store_chart(db, data)
+        crud.discard_unreferenced_blobs(db, [second])
+        assert blob_exists(first)
+        crud.collect_orphan_blobs(db)
+        assert blob_exists(first)
+
+        crud.discard_unreferenced_blobs(db, [first])
+        assert not blob_exists(first)
+
+
+async def test_referenced_blob_survives_failed_upload(client):
+    from db import crud
+    from db.database import SessionLocal
+
+    data = os.urandom(512)
+    with SessionLocal() as db:
+        kept = await store_chart(db, data)
+        crud.acquire_blobs(db, [kept])
+        db.commit()
+        failed = await store_chart(db, data)
+        crud.discard_unreferenced_blobs(db, [failed])
+        assert blob_exists(kept)
+
+        crud.release_blobs(db, [kept.name])
+        db.commit()
+        assert crud.collect_orphan_blobs(db) == [(kept.kind, kept.name)]
+        assert not blob_exists(kept)
+
+
+async def test_stale_leases_are_cleared(client):
+    from db import crud
+    from db.database import SessionLocal
+
+    with SessionLocal() as db:
+        # a worker was killed between storing the file and committing its song
+        abandoned = await store_chart(db, os.urandom(512))
+        crud.collect_orphan_blobs(db)
+        assert blob_exists(abandoned)
+        crud.clear_blob_leases(db)
+        assert not blob_exists(abandoned)
+
+
+async def test_stored_again_keeps_last_modified(client):
+    from db import crud
+    from db.database import SessionLocal
+    from files.blobs import blob_store
+
+    data = os.urandom(512)
+    with SessionLocal() as db:
+        first = await store_chart(db, data)
+        path = blob_store.local_path(first.kind, first.name)
+        os.utime(path, (1_000_000_000, 1_000_000_000))
+        second = await store_chart(db, data)
+        assert os.path.getmtime(path) == 1_000_000_000
+        assert not os.listdir(blob_store.backend.temp_dir)
+        crud.discard_unreferenced_blobs(db, [first, second])
@@ -0,0 +1,21 @@
+"""
+A favs update is rejected as a whole when it both adds and removes a song,
+rather than applying one and silently reporting the other.
+"""
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_add_and_remove_same_song(client, auth_headers):
+    from db import crud
+    from db.database import SessionLocal
+
+    headers = auth_headers(3)
+    with SessionLocal() as db:
+        version = crud.get_catalogue_version(db)
+    response = await client.patch("/users/me/favs", json={"add": [5, 6], "remove": [6, 7]}, headers=headers)
+    assert response.status_code == 400
+    assert "6" in response.json()["detail"]
+    with SessionLocal() as db:
+        assert crud.get_catalogue_version(db) == version
@@ -0,0 +1,42 @@
+"""
+Password hashing jobs abandoned by their request give their queue slot back,
+so cancelled logins never leave the hasher rejecting everyone.
+"""
+import asyncio
+import threading
+
+import pytest
+
+from security.hashing import PasswordHasher
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_cancelled_jobs_leave_the_queue():
+    hasher = PasswordHasher(max_workers=1, max_queue=4)
+    started = threading.Event()
+    release = threading.Event()
+
+    def blocking(*args):
+        started.set()
+        release.wait()
+        return "done"
+    hasher.context.hash = blocking
+    running = asyncio.ensure_future(hasher.hash_async("running"))
+    await asyncio.get_running_loop().run_in_executor(None, started.wait)
+
+    try:
+        waiting = [asyncio.ensure_future(hasher.hash_async(f"waiting{i}")) for i in range(3)]
+        await asyncio.sleep(0)
+        assert hasher.stats()["queued"] == 3
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        assert hasher.stats()["queued"] == 0
+    finally:
+        release.set()
+    assert await running == "done"
+    assert await hasher.hash_async("again") == "done"
+    stats = hasher.stats()
+    assert stats["queued"] == 0 and stats["running"] == 0
+    hasher.shutdown()
@@ -0,0 +1,54 @@
+"""
+Signed-in song pages must take the same number of SQL statements however
+many songs are on the page and however many of them are faved.
+"""
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+# the songs with their fav flags, then the charts of the whole page
+SONG_PAGE_STATEMENTS = 2
+# the song with its fav flag, then its charts
+SONG_STATEMENTS = 2
+
+
+async def fav_first_songs(client, headers, count):
+    response = await client.patch("/users/me/favs", json={"add": list(range(1, count + 1))}, headers=headers)
+    assert response.status_code == 200
+
+
+async def test_song_page(client, statements, auth_headers):
+    headers = auth_headers(1)
+    await fav_first_songs(client, headers, 100)
+    for limit in (10, 100):
+        statements.clear()
+        response = await client.get("/songs/", params={"limit": limit}, headers=headers)
+        assert response.status_code == 200
+        songs = response.json()
+        assert len(songs) == limit
+        assert all(song["isFaved"] for song in songs)
+        assert len(statements) == SONG_PAGE_STATEMENTS, statements
+
+
+async def test_song_page_after_cursor(client, statements, auth_headers):
+    headers = auth_headers(1)
+    await fav_first_songs(client, headers, 100)
+    first = await client.get("/songs/", params={"limit": 50}, headers=headers)
+    statements.clear()
+    response = await client.get("/songs/", params={"limit": 50, "after": first.headers["X-Next-Cursor"]}, headers=headers)
+    assert response.status_code == 200
+    assert [song["id"] for song in response.json()] == list(range(51, 101))
+    assert len(statements) == SONG_PAGE_STATEMENTS, statements
+
+
+@pytest.mark.parametrize("faved", [True, False])
+async def test_song(client, statements, auth_headers, faved):
+    headers = auth_headers(1)
+    # song 1 is the most faved song of the catalogue
+    change = {"add": [1]} if faved else {"remove": [1]}
+    assert (await client.patch("/users/me/favs", json=change, headers=headers)).status_code == 200
+    statements.clear()
+    response = await client.get("/songs/1", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["isFaved"] is faved
+    assert len(statements) == SONG_STATEMENTS, statements
@@ -0,0 +1,30 @@
+"""
+Anonymous catalogue responses are cached under the catalogue version they
+were read at, so a change committed during the read is never hidden.
+"""
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_response_read_before_a_change_is_not_served(client, monkeypatch):
+    from cache.responses import response_cache
+    from db import crud
+
+    get_total_songs = crud.get_total_songs
+    reads = []
+
+    def racing_read(db):
+        total = get_total_songs(db)
+        if not reads:
+            # a song is uploaded after this read, before the response is stored
+            response_cache.invalidate()
+        reads.append(total)
+        return total
+    monkeypatch.setattr(crud, "get_total_songs", racing_read)
+
+    await client.get("/info")
+    await client.get("/info")
+    assert len(reads) == 2
+    await client.get("/info")
+    assert len(reads) == 2
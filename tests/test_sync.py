@@ -0,0 +1,28 @@
+"""
+Every change a listing shows is also in the change log behind /sync, so a
+client syncing from its last version sees the same catalogue.
+"""
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_deleted_uploader_is_synced(client, auth_headers):
+    from db import crud, models
+    from db.database import SessionLocal
+
+    user_id = 20
+    with SessionLocal() as db:
+        uploaded = sorted(song_id for song_id, in db.query(models.Song.id).filter(models.Song.uploader == user_id))
+        since = crud.get_catalogue_version(db)
+    assert uploaded
+    headers = auth_headers(user_id)
+    await client.patch("/users/me/favs", json={"add": [1]}, headers=headers)
+
+    response = await client.delete("/users/me", headers=headers)
+    assert response.status_code == 200
+    delta = (await client.get("/sync", params={"since": since})).json()
+    assert sorted(song["id"] for song in delta["songs"]) == uploaded
+    assert all(song["uploader"] is None for song in delta["songs"])
+    with SessionLocal() as db:
+        assert not db.query(models.CatalogueChange).filter(models.CatalogueChange.user_id == user_id).count()
@@ -0,0 +1,128 @@
+"""
+Song uploads are streamed to storage in fixed-size chunks, so memory stays
+flat however large the audio is, and a rejected upload leaves nothing behind.
+"""
+import os
+import random
+import resource
+import sys
+
+import pytest
+
+from conftest import STORAGE_DIR
+
+pytestmark = pytest.mark.anyio
+
+MB = 1024 * 1024
+LARGE_UPLOAD_MB = 256
+# far below the upload itself, which would show up whole if it were buffered
+MAX_RSS_GROWTH_MB = 64
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def stored_files():
+    found = set()
+    for kind in ("audio", "images", "charts", "tmp"):
+        directory = os.path.join(STORAGE_DIR, kind)
+        if os.path.isdir(directory):
+            found.update(os.path.join(kind, name) for name in os.listdir(directory))
+    return found
+
+
+def sparse_file(path, size):
+    # reads back as zeros without taking any memory or disk up front
+    with open(path, "wb") as f:
+        f.truncate(size)
+    return path
+
+
+def upload_files(audio, rng, charts=None):
+    from bench import catalogue
+
+    files = {
+        "song_info": ("song.xml", catalogue.song_info_xml(catalogue.title(rng), catalogue.title(rng))),
+        "audio": ("song.wav", audio, "audio/wav"),
+        "art": ("jacket.png", catalogue.png_bytes(rng, 64), "image/png"),
+    }
+    for level, _, _ in catalogue.LEVELS:
+        files[level] = (f"{level}.chart", (charts or {}).get(level) or catalogue.chart_bytes(rng, 50))
+    return files
+
+
+async def test_large_upload_memory(client, auth_headers, tmp_path):
+    headers = auth_headers(1)
+    path = sparse_file(tmp_path / "large.wav", LARGE_UPLOAD_MB * MB)
+    before = peak_rss_mb()
+    with open(path, "rb") as audio:
+        response = await client.post("/songs/", files=upload_files(audio, random.Random(1)), headers=headers)
+    growth = peak_rss_mb() - before
+    assert response.status_code == 200, response.text
+    song = response.json()
+    assert os.path.getsize(os.path.join(STORAGE_DIR, "audio", song["music"])) == LARGE_UPLOAD_MB * MB
+    assert growth < MAX_RSS_GROWTH_MB, f"peak RSS grew by {growth:.0f} MB"
+
+    assert (await client.delete(f"/songs/{song['id']}", headers=headers)).status_code == 200
+    assert not os.path.exists(os.path.join(STORAGE_DIR, "audio", song["music"]))
+
+
+async def test_audio_over_limit(client, auth_headers, tmp_path, monkeypatch):
+    import main
+
+    monkeypatch.setitem(main.UPLOAD_LIMITS, "audio", 8 * MB)
+    before = stored_files()
+    path = sparse_file(tmp_path / "too-large.wav", 32 * MB)
+    with open(path, "rb") as audio:
+        response = await client.post("/songs/", files=upload_files(audio, random.Random(2)), headers=auth_headers(1))
+    assert response.status_code == 413
+    assert "audio" in response.json()["detail"]
+    assert stored_files() == before
+
+
+async def test_chart_over_limit_discards_stored_parts(client, auth_headers, monkeypatch):
+    import main
+
+    monkeypatch.setitem(main.UPLOAD_LIMITS, "chart", 1024)
+    rng = random.Random(3)
+    before = stored_files()
+    # audio, jacket and easy are stored before hard turns out too large
+    audio = os.urandom(2 * MB)
+    files = upload_files(audio, rng, charts={"hard": b"0,0,t\n" * 1000})
+    response = await client.post("/songs/", files=files, headers=auth_headers(1))
+    assert response.status_code == 413
+    assert "hard" in response.json()["detail"]
+    assert stored_files() == before
+
+
+async def test_gzip_chart_upload(client, auth_headers):
+    import gzip
+
+    headers = auth_headers(1)
+    rng = random.Random(4)
+    chart = b"0,0,t\n1,2,h\n" * 200
+    files = upload_files(os.urandom(64 * 1024), rng, charts={"normal": gzip.compress(chart)})
+    response = await client.post("/songs/", files=files, headers=headers)
+    assert response.status_code == 200, response.text
+    song_id = response.json()["id"]
+    download = await client.get(f"/songs/{song_id}/normal", headers={"Accept-Encoding": "identity"})
+    assert download.content == chart
+    assert (await client.delete(f"/songs/{song_id}", headers=headers)).status_code == 200
+
+
+async def test_gzip_chart_over_limit(client, auth_headers, monkeypatch):
+    import gzip
+
+    import main
+
+    monkeypatch.setitem(main.UPLOAD_LIMITS, "chart", 1024)
+    before = stored_files()
+    # a few hundred bytes on the wire, far past the limit once unpacked
+    files = upload_files(os.urandom(64 * 1024), random.Random(5), charts={"hard": gzip.compress(b"0,0,t\n" * 100_000)})
+    response = await client.post("/songs/", files=files, headers=auth_headers(1))
+    assert response.status_code == 413
+    assert "hard" in response.json()["detail"]
+    assert stored_files() == before